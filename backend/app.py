@@ -3,9 +3,15 @@ Flask Backend for SVS Tile Viewer with Annotation & QC Support
 Serves DZI tiles, manages GeoJSON annotations, and Phase 1 QC Status
 """
 
-from flask import Flask, jsonify, request, send_from_directory, make_response
+from flask import Flask, Response, abort, request, send_from_directory, make_response
 from flask_cors import CORS
+from werkzeug.security import safe_join
 import json
+import mimetypes
+import orjson
+import os
+import tempfile
+from urllib.parse import quote
 from pathlib import Path
 from datetime import datetime
 
@@ -19,6 +25,12 @@ COSMX_DIR = Path(r"D:\병리\data\cosmx")
 COSMX_TILES_DIR = Path(r"D:\병리\data\cosmx_tiles")
 QC_DIR = Path(r"D:\병리\data\qc_results") # Phase 1: QC 상태 저장 폴더
 
+# Tile offload to the front-end web server (Flask only returns a header):
+#   USE_XACCEL=1      -> nginx X-Accel-Redirect to the internal /_tiles/, /_cosmx_tiles/ locations
+#   USE_X_SENDFILE=1  -> Apache/lighttpd X-Sendfile (handled by send_from_directory itself)
+USE_XACCEL = bool(os.environ.get('USE_XACCEL'))
+app.config['USE_X_SENDFILE'] = bool(os.environ.get('USE_X_SENDFILE'))
+
 # Ensure directories exist
 TILES_DIR.mkdir(parents=True, exist_ok=True)
 ANNOTATIONS_DIR.mkdir(parents=True, exist_ok=True)
@@ -26,43 +38,102 @@ COSMX_DIR.mkdir(parents=True, exist_ok=True)
 COSMX_TILES_DIR.mkdir(parents=True, exist_ok=True)
 QC_DIR.mkdir(parents=True, exist_ok=True)
 
+# Annotation read cache: str(path) -> ((st_ino, st_mtime_ns, st_size), raw JSON bytes)
+_ANN_CACHE = {}
+_EMPTY_FEATURE_COLLECTION = orjson.dumps({"type": "FeatureCollection", "features": []})
+
+# mkstemp creates 0600 files -> saved annotations get the mode open(..., 'w') would give
+# (os.umask can only be read by setting it; done once here, before any request threads)
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+_ANN_FILE_MODE = 0o666 & ~_UMASK
+
+# /api/slides payload, rebuilt when TILES_DIR's mtime changes
+_SLIDES_CACHE = {'mtime': -1, 'body': b''}
+
 # ============================================================================
 # COMMON RESPONSE HEADERS (CORS/CORP)
 # ============================================================================
 
+# make_dzi.py / make_cosmx_dzi.py regenerate a slide in place (same URLs), so tiles and the
+# .dzi descriptor are cached briefly and then revalidated with the mtime/size ETag and
+# Last-Modified that send_from_directory adds (304 if unchanged). No `immutable`: nothing
+# here is content-addressed. The .dzi decides which tiles get requested -> shorter max-age.
+# 206 (Range request on a tile) is a slice of the same file/ETag -> same policy as 200.
+TILE_PATH_PREFIXES = ('/tiles/', '/cosmx_tiles/')
+TILE_CACHE_CONTROL = 'public, max-age=300, must-revalidate'
+DZI_CACHE_CONTROL = 'public, max-age=60, must-revalidate'
+CACHEABLE_STATUSES = (200, 206, 304)
+
 def _add_common_headers(resp):
     resp.headers['Access-Control-Allow-Origin'] = '*'
     resp.headers['Access-Control-Allow-Headers'] = '*'
     resp.headers['Access-Control-Allow-Methods'] = 'GET,HEAD,OPTIONS'
     resp.headers['Cross-Origin-Resource-Policy'] = 'cross-origin'
-    resp.headers['Cache-Control'] = 'no-store'
+    if request.path.startswith(TILE_PATH_PREFIXES) and resp.status_code in CACHEABLE_STATUSES:
+        if request.path.endswith('.dzi'):
+            resp.headers['Cache-Control'] = DZI_CACHE_CONTROL
+        else:
+            resp.headers['Cache-Control'] = TILE_CACHE_CONTROL
+    else:
+        resp.headers['Cache-Control'] = 'no-store'
     return resp
 
 @app.after_request
 def after_request(resp):
     return _add_common_headers(resp)
 
+# orjson-backed replacement for jsonify; CORS/cache headers are still added in after_request
+def _json_response(obj, status=200):
+    return Response(orjson.dumps(obj), status=status, mimetype='application/json')
+
 # ============================================================================
 # TILE SERVING ENDPOINTS
 # ============================================================================
 
 @app.route('/api/slides', methods=['GET'])
 def list_slides():
+    mtime = os.stat(TILES_DIR).st_mtime_ns
+    if _SLIDES_CACHE['mtime'] == mtime:
+        return Response(_SLIDES_CACHE['body'], mimetype='application/json')
+
     slides = []
-    for slide_dir in TILES_DIR.iterdir():
-        if slide_dir.is_dir():
-            dzi_file = slide_dir / f"{slide_dir.name}.dzi"
-            if dzi_file.exists():
+    pending = False
+    with os.scandir(TILES_DIR) as entries:
+        for entry in entries:
+            if not entry.is_dir():
+                continue
+            if os.path.isfile(os.path.join(entry.path, f"{entry.name}.dzi")):
                 slides.append({
-                    'id': slide_dir.name,
-                    'name': slide_dir.name,
-                    'dzi_url': f"/tiles/{slide_dir.name}/{slide_dir.name}.dzi"
+                    'id': entry.name,
+                    'name': entry.name,
+                    'dzi_url': f"/tiles/{entry.name}/{entry.name}.dzi"
                 })
-    return jsonify(slides)
+            else:
+                pending = True
+
+    body = orjson.dumps(slides)
+    # A slide dir without its .dzi may still be generating (dzsave writes the .dzi last,
+    # which does not touch TILES_DIR's mtime) -> don't cache until it is complete
+    _SLIDES_CACHE['mtime'] = -1 if pending else mtime
+    _SLIDES_CACHE['body'] = body
+    return Response(body, mimetype='application/json')
+
+def _serve_tile(directory, filepath, internal_prefix):
+    if not USE_XACCEL:
+        return send_from_directory(directory, filepath)
+    full = safe_join(str(directory), filepath)
+    if full is None:
+        abort(404)
+    rel = Path(full).relative_to(directory).as_posix()
+    resp = Response(status=200,
+                    mimetype=mimetypes.guess_type(rel)[0] or 'application/octet-stream')
+    resp.headers['X-Accel-Redirect'] = internal_prefix + quote(rel)
+    return resp
 
 @app.route('/tiles/<path:filepath>')
 def serve_tiles(filepath):
-    return send_from_directory(TILES_DIR, filepath)
+    return _serve_tile(TILES_DIR, filepath, '/_tiles/')
 
 # ============================================================================
 # QC STATUS ENDPOINTS (For Phase 1 Sample Selection)
@@ -72,9 +143,9 @@ def serve_tiles(filepath):
 def get_qc_status(slide_id):
     qc_file = QC_DIR / f"{slide_id}.json"
     if qc_file.exists():
-        with open(qc_file, 'r', encoding='utf-8') as f:
-            return jsonify(json.load(f))
-    return jsonify({'status': 'unreviewed'})
+        # Stored file is already JSON -> serve bytes without parse/re-encode
+        return Response(qc_file.read_bytes(), mimetype='application/json')
+    return _json_response({'status': 'unreviewed'})
 
 @app.route('/api/qc/<slide_id>', methods=['POST'])
 def save_qc_status(slide_id):
@@ -91,7 +162,7 @@ def save_qc_status(slide_id):
     with open(qc_file, 'w', encoding='utf-8') as f:
         json.dump(qc_data, f, indent=2)
         
-    return jsonify({'status': 'success', 'qc_status': qc_data['status']})
+    return _json_response({'status': 'success', 'qc_status': qc_data['status']})
 
 # ============================================================================
 # ANNOTATION ENDPOINTS (GeoJSON)
@@ -100,28 +171,59 @@ def save_qc_status(slide_id):
 @app.route('/api/annotations/<slide_id>', methods=['GET'])
 def get_annotations(slide_id):
     annotation_file = ANNOTATIONS_DIR / f"{slide_id}.json"
-    if not annotation_file.exists():
-        return jsonify({"type": "FeatureCollection", "features": []})
-    with open(annotation_file, 'r', encoding='utf-8') as f:
-        return jsonify(json.load(f))
+    key = str(annotation_file)
+    try:
+        st = annotation_file.stat()
+    except FileNotFoundError:
+        _ANN_CACHE.pop(key, None)
+        return Response(_EMPTY_FEATURE_COLLECTION, mimetype='application/json')
+
+    # mtime alone misses a save from another worker within the same mtime tick (coarse-mtime
+    # filesystems); save_annotations swaps in a new file, so the inode changes on every save
+    sig = (st.st_ino, st.st_mtime_ns, st.st_size)
+    cached = _ANN_CACHE.get(key)
+    if cached is None or cached[0] != sig:
+        # File on disk is already valid JSON (written by save_annotations) -> serve as-is
+        cached = (sig, annotation_file.read_bytes())
+        _ANN_CACHE[key] = cached
+    return Response(cached[1], mimetype='application/json')
 
 @app.route('/api/annotations/<slide_id>', methods=['POST'])
 def save_annotations(slide_id):
     annotation_file = ANNOTATIONS_DIR / f"{slide_id}.json"
-    data = request.json
+    # Same contract as request.json: non-JSON Content-Type -> 415
+    if not request.is_json:
+        abort(415)
+    # Parse once for validation only; the body is written to disk unchanged
+    raw = request.get_data(cache=False)
+    try:
+        data = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        data = None
     if not isinstance(data, dict) or data.get('type') != 'FeatureCollection':
-        return jsonify({'error': 'Invalid GeoJSON format'}), 400
-    with open(annotation_file, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=2)
-    return jsonify({'status': 'success', 'saved': len(data.get('features', []))})
+        return _json_response({'error': 'Invalid GeoJSON format'}, 400)
+    # Write a temp file and swap it in: readers never see a half-written file, and the new
+    # inode invalidates every worker's read cache
+    fd, tmp_path = tempfile.mkstemp(dir=ANNOTATIONS_DIR, prefix=f".{slide_id}.", suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(raw)
+        os.chmod(tmp_path, _ANN_FILE_MODE)
+        os.replace(tmp_path, annotation_file)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    _ANN_CACHE.pop(str(annotation_file), None)
+    return _json_response({'status': 'success', 'saved': len(data.get('features', []))})
 
 @app.route('/api/annotations/<slide_id>', methods=['DELETE'])
 def delete_annotations(slide_id):
     annotation_file = ANNOTATIONS_DIR / f"{slide_id}.json"
     if annotation_file.exists():
         annotation_file.unlink()
-        return jsonify({'status': 'deleted'})
-    return jsonify({'status': 'not_found'}), 404
+        _ANN_CACHE.pop(str(annotation_file), None)
+        return _json_response({'status': 'deleted'})
+    return _json_response({'status': 'not_found'}, 404)
 
 # ============================================================================
 # COSMX DZI ENDPOINTS
@@ -135,28 +237,28 @@ def get_cosmx_dzi(slide_id):
     original_dzi   = COSMX_TILES_DIR / slide_id / f"{slide_id}.dzi"
 
     if registered_dzi.exists():
-        return jsonify({
+        return _json_response({
             'has_cosmx': True,
             'dzi_url':   f"/cosmx_tiles/{slide_id}/{slide_id}_registered.dzi",
             'slide_id':  slide_id,
             'registered': True
         })
     elif original_dzi.exists():
-        return jsonify({
+        return _json_response({
             'has_cosmx': True,
             'dzi_url':   f"/cosmx_tiles/{slide_id}/{slide_id}.dzi",
             'slide_id':  slide_id,
             'registered': False
         })
     else:
-        return jsonify({'error': 'No CosMx data for this slide'}), 404
+        return _json_response({'error': 'No CosMx data for this slide'}, 404)
 
 @app.route('/api/cosmx/<slide_id>/transform', methods=['GET'])
 def get_cosmx_transform(slide_id):
     # registered DZI가 있으면 identity 반환
     registered_dzi = COSMX_TILES_DIR / slide_id / f"{slide_id}_registered.dzi"
     if registered_dzi.exists():
-        return jsonify({
+        return _json_response({
             'version':  '1.0',
             'slide_id': slide_id,
             'transform': 'identity',
@@ -166,10 +268,9 @@ def get_cosmx_transform(slide_id):
     for fname in ['transform_registered.json', 'transform.json']:
         tf_file = COSMX_TILES_DIR / slide_id / fname
         if tf_file.exists():
-            with open(tf_file, 'r', encoding='utf-8') as f:
-                return jsonify(json.load(f))
+            return Response(tf_file.read_bytes(), mimetype='application/json')
 
-    return jsonify({
+    return _json_response({
         'version':  '1.0',
         'slide_id': slide_id,
         'transform': 'identity',
@@ -178,7 +279,7 @@ def get_cosmx_transform(slide_id):
 
 @app.route('/cosmx_tiles/<path:filepath>')
 def serve_cosmx_tiles(filepath):
-    return send_from_directory(COSMX_TILES_DIR, filepath)
+    return _serve_tile(COSMX_TILES_DIR, filepath, '/_cosmx_tiles/')
 
 # ============================================================================
 # HEALTH CHECK
@@ -186,9 +287,21 @@ def serve_cosmx_tiles(filepath):
 
 @app.route('/health')
 def health():
-    return jsonify({'status': 'healthy', 'service': 'SVS Tile Viewer'})
+    return _json_response({'status': 'healthy', 'service': 'SVS Tile Viewer'})
 
 if __name__ == '__main__':
     print("🚀 Starting SVS Tile Viewer Backend...")
     print(f"📂 QC directory: {QC_DIR.absolute()}")
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    if os.environ.get('FLASK_DEV'):
+        # Development only: reloader + debugger, single process
+        app.run(debug=True, host='0.0.0.0', port=5000)
+    else:
+        # Production: prefer a multi-worker WSGI server, e.g.
+        #   gunicorn -k gthread -w $(nproc) --threads 8 -b 0.0.0.0:5000 app:app
+        try:
+            from waitress import serve
+            print("🧵 Serving with waitress (16 threads)")
+            serve(app, host='0.0.0.0', port=5000, threads=16)
+        except ImportError:
+            print("⚠️  Built-in threaded server; use gunicorn/waitress for production (see README)")
+            app.run(host='0.0.0.0', port=5000, threaded=True)
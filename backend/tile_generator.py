@@ -24,11 +24,47 @@ Notes:
   - The Flask backend expects DZI at: data/tiles/<slide>/<slide>.dzi
 """
 
+import os
 import sys
 from pathlib import Path
+
+# libvips reads VIPS_CONCURRENCY when it initialises -> must be set before the import
+os.environ.setdefault('VIPS_CONCURRENCY', str(os.cpu_count() or 1))
+
 import pyvips
 
-def generate_dzi_tiles(svs_path: Path, output_dir: Path, tile_size: int = 256, overlap: int = 1, suffix: str = ".jpg"):
+# dzsave streams the slide once; the operation cache only holds on to memory
+pyvips.cache_set_max(0)
+pyvips.cache_set_max_mem(0)
+
+def set_concurrency(threads: int):
+    """libvips worker threads for this process (batch scripts split the CPUs across their worker processes)"""
+    os.environ['VIPS_CONCURRENCY'] = str(threads)   # inherited by spawned child processes
+    if hasattr(pyvips, 'concurrency_set'):          # older pyvips: libvips only reads the env at init
+        pyvips.concurrency_set(threads)
+
+def dz_suffix(fmt: str = "jpg", quality: int = 90) -> str:
+    """dzsave tile suffix for fmt ('jpg' / 'jpeg' / 'png') — JPEG: libjpeg-turbo, optimized Huffman tables, no metadata"""
+    if fmt == "png":
+        return ".png[compression=6]"
+    return f".{fmt}[Q={quality},optimize_coding,strip]"
+
+
+DEFAULT_SUFFIX = dz_suffix()
+
+def generate_dzi_tiles(svs_path: Path, output_dir: Path, tile_size: int = 256, overlap: int = 1,
+                       suffix: str = DEFAULT_SUFFIX, depth: str = "one", container: str = "fs"):
+    """
+    Shared pyvips DZI export (also used by codes/make_dzi.py and codes/make_cosmx_dzi.py).
+
+    Any libvips-readable input works: .svs via the openslide loader, .png via the PNG loader.
+      suffix:      tile format/options, see dz_suffix()
+      depth:       'one' (single level), 'onetile' or 'onepixel' (full DeepZoom pyramid down to 1x1)
+      container:   'fs' (<name>.dzi + <name>_files/) or 'zip' (single uncompressed <name>.zip)
+
+    Background tiles are always written: libvips skip_blanks only compares against one colour,
+    so the scripts' --skip-background uses their own tissue-mask tiler instead.
+    """
     if not svs_path.exists():
         raise FileNotFoundError(f"SVS not found: {svs_path}")
 
@@ -38,7 +74,7 @@ def generate_dzi_tiles(svs_path: Path, output_dir: Path, tile_size: int = 256, o
     tile_dir = output_dir / slide_name
     tile_dir.mkdir(parents=True, exist_ok=True)
 
-    dzi_path = tile_dir / f"{slide_name}.dzi"
+    dzi_path = tile_dir / (f"{slide_name}.zip" if container == "zip" else f"{slide_name}.dzi")
 
     print(f"📂 Loading slide: {svs_path.name}")
 
@@ -54,6 +90,15 @@ def generate_dzi_tiles(svs_path: Path, output_dir: Path, tile_size: int = 256, o
     print(f"📐 Image size: {image.width} x {image.height}")
     print(f"🧩 Generating DeepZoom tiles -> {dzi_path}")
 
+    # JPEG has no alpha (openslide/RGBA PNG input) -> composite on white
+    if not suffix.startswith(".png") and image.hasalpha():
+        image = image.flatten(background=[255, 255, 255])
+
+    options = {}
+    if container == "zip":
+        options['container'] = 'zip'
+        options['compression'] = 0   # tiles are already JPEG/PNG compressed
+
     # dzsave writes: <basename>.dzi and <basename>_files/
     # We want basename to be inside tile_dir, and to be slide_name
     base = tile_dir / slide_name
@@ -63,7 +108,8 @@ def generate_dzi_tiles(svs_path: Path, output_dir: Path, tile_size: int = 256, o
         tile_size=tile_size,
         overlap=overlap,
         suffix=suffix,
-        depth='one'  # creates lower levels; 'one' is OK for DeepZoom pyramid
+        depth=depth,  # 'one' keeps only full resolution; DeepZoom viewers want 'onepixel'
+        **options
     )
 
     if not dzi_path.exists():
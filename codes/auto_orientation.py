@@ -22,13 +22,28 @@ V8.1 변경사항 (V8 대비 최소 수정):
 
 import numpy as np
 import cv2
-import json
+import scipy.fft
+import orjson
 from pathlib import Path
 import argparse
+import functools
+import hashlib
+import heapq
+import operator
+import os
+import tempfile
 from PIL import Image
 import sys
 import io
 
+from common import iter_files
+
+try:
+    from numba import njit, prange
+    _HAS_NUMBA = True
+except ImportError:  # numba는 선택 사항 — 없으면 NumPy 경로 사용
+    _HAS_NUMBA = False
+
 if sys.platform == "win32":
     sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
     sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8')
@@ -40,9 +55,50 @@ Image.MAX_IMAGE_PIXELS = None
 # IMAGE LOADING
 # ============================================================================
 
-def load_he_image(he_path, max_size=1024):
-    print(f"  [Load] H&E: {Path(he_path).name}")
-    he_path = Path(he_path)
+# 축소 이미지(.npz) 캐시 — 같은 (경로, max_size, mtime)이면 SVS/PNG decode 생략
+# 원본 옆(<name>.thumb<size>.npz)에 저장, 쓸 수 없는 디렉토리면 temp 폴더 사용
+THUMB_CACHE_DIR = Path(tempfile.gettempdir()) / 'auto_orientation_thumbs'
+
+
+def _thumb_cache_paths(src_path, max_size):
+    key = hashlib.sha1(f"{src_path.resolve()}|{max_size}".encode('utf-8')).hexdigest()[:16]
+    return [src_path.with_name(f"{src_path.name}.thumb{max_size}.npz"),
+            THUMB_CACHE_DIR / f"thumb_{key}.npz"]
+
+
+def _cached_thumbnail(src_path, max_size, decode_fn):
+    src_path = Path(src_path)
+    mtime_ns = src_path.stat().st_mtime_ns
+    caches   = _thumb_cache_paths(src_path, max_size)
+
+    for cache in caches:
+        if not cache.exists():
+            continue
+        try:
+            with np.load(cache) as z:
+                if int(z['src_mtime_ns']) != mtime_ns:
+                    continue  # 원본이 바뀜 → 다시 decode 후 덮어씀
+                img, orig_size = z['img'], tuple(int(v) for v in z['orig_size'])
+            print(f"    [Cache] thumbnail hit ({cache})")
+            return img, orig_size
+        except (OSError, ValueError, KeyError):
+            pass
+
+    img, orig_size = decode_fn(src_path, max_size)
+    for cache in caches:
+        try:
+            cache.parent.mkdir(parents=True, exist_ok=True)
+            tmp = cache.with_name(cache.stem + '.tmp.npz')
+            np.savez(tmp, img=img, orig_size=np.array(orig_size),
+                     src_mtime_ns=np.int64(mtime_ns))
+            os.replace(tmp, cache)
+            break
+        except OSError as e:
+            print(f"    [Cache] thumbnail not saved to {cache.parent}: {e}")
+    return img, orig_size
+
+
+def _decode_he_image(he_path, max_size):
     if he_path.suffix.lower() == '.svs':
         try:
             from openslide import OpenSlide
@@ -57,48 +113,88 @@ def load_he_image(he_path, max_size=1024):
     else:
         pil_img = Image.open(str(he_path))
         orig_size = pil_img.size
+        # JPEG이면 libjpeg가 1/2~1/8 크기로 바로 decode (convert가 full decode 하기 전에 호출)
+        pil_img.draft('RGB', (max_size, max_size))
         if pil_img.mode != 'RGB':
             pil_img = pil_img.convert('RGB')
         pil_img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
         return cv2.cvtColor(np.array(pil_img), cv2.COLOR_RGB2BGR), orig_size
 
 
-def load_cosmx_image(cosmx_path, max_size=1024):
-    print(f"  [Load] CosMx: {Path(cosmx_path).name}")
+def _decode_cosmx_image(cosmx_path, max_size):
     pil_img = Image.open(str(cosmx_path))
     orig_size = pil_img.size
+    pil_img.draft('RGB', (max_size, max_size))
     if pil_img.mode == 'RGBA':
+        # 축소 먼저 (PIL resize는 alpha premultiply) → 작은 이미지에서 흰 배경 합성
+        pil_img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
         bg = Image.new('RGB', pil_img.size, (255, 255, 255))
         bg.paste(pil_img, mask=pil_img.split()[3])
         pil_img = bg
-    elif pil_img.mode != 'RGB':
-        pil_img = pil_img.convert('RGB')
-    pil_img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+    else:
+        if pil_img.mode != 'RGB':
+            pil_img = pil_img.convert('RGB')
+        pil_img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
     return cv2.cvtColor(np.array(pil_img), cv2.COLOR_RGB2BGR), orig_size
 
 
+def load_he_image(he_path, max_size=1024):
+    print(f"  [Load] H&E: {Path(he_path).name}")
+    return _cached_thumbnail(he_path, max_size, _decode_he_image)
+
+
+def load_cosmx_image(cosmx_path, max_size=1024):
+    print(f"  [Load] CosMx: {Path(cosmx_path).name}")
+    return _cached_thumbnail(cosmx_path, max_size, _decode_cosmx_image)
+
+
 # ============================================================================
 # MASK GENERATION
 # ============================================================================
 
+# Morphology kernels (allocated once, shared by every mask call)
+_K5  = cv2.getStructuringElement(cv2.MORPH_RECT, (5, 5))
+_K7  = cv2.getStructuringElement(cv2.MORPH_RECT, (7, 7))
+_K9  = cv2.getStructuringElement(cv2.MORPH_RECT, (9, 9))
+_K15 = cv2.getStructuringElement(cv2.MORPH_RECT, (15, 15))
+
+def _components_to_mask(labels, keep):
+    """keep[label] == True 인 component만 255 — labels == i 루프 대신 LUT 한 번으로 처리"""
+    keep[0] = False  # background
+    lut = np.where(keep, 255, 0).astype(np.uint8)
+    return lut[labels]
+
+
+def _drop_border_frames(raw):
+    """테두리에 닿는 크고 속이 빈 component(유리판 프레임 등) 제거"""
+    h_img, w_img = raw.shape
+    _, labels, stats, _ = cv2.connectedComponentsWithStats(raw, connectivity=8)
+    area = stats[:, cv2.CC_STAT_AREA]
+    bx   = stats[:, cv2.CC_STAT_LEFT]
+    by   = stats[:, cv2.CC_STAT_TOP]
+    bw   = stats[:, cv2.CC_STAT_WIDTH]
+    bh   = stats[:, cv2.CC_STAT_HEIGHT]
+    bbox_area      = bw * bh
+    solid_ratio    = area / np.maximum(bbox_area, 1)
+    touches_border = (bx <= 3) | (by <= 3) | (bx+bw >= w_img-3) | (by+bh >= h_img-3)
+    large_bbox     = (bw > w_img * 0.5) & (bh > h_img * 0.5)
+    keep = (bbox_area > 0) & ~(touches_border & large_bbox & (solid_ratio < 0.25))
+    return _components_to_mask(labels, keep)
+
+
 def _remove_fiducial_blobs(mask, img_h, img_w, max_area_ratio=0.003, min_aspect=0.6):
-    n_labels, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
-    clean    = np.zeros_like(mask)
+    _, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
     img_area = img_h * img_w
-    for i in range(1, n_labels):
-        area      = stats[i, cv2.CC_STAT_AREA]
-        bw        = stats[i, cv2.CC_STAT_WIDTH]
-        bh        = stats[i, cv2.CC_STAT_HEIGHT]
-        if bw == 0 or bh == 0:
-            continue
-        aspect      = min(bw, bh) / max(bw, bh)
-        solidity    = area / (bw * bh)
-        area_ratio  = area / img_area
-        is_fiducial = (area_ratio < max_area_ratio and aspect > min_aspect
-                       and solidity > 0.65 and area > 10)
-        if not is_fiducial:
-            clean[labels == i] = 255
-    return clean
+    area     = stats[:, cv2.CC_STAT_AREA]
+    bw       = stats[:, cv2.CC_STAT_WIDTH]
+    bh       = stats[:, cv2.CC_STAT_HEIGHT]
+    valid       = (bw > 0) & (bh > 0)
+    aspect      = np.minimum(bw, bh) / np.maximum(np.maximum(bw, bh), 1)
+    solidity    = area / np.maximum(bw * bh, 1)
+    area_ratio  = area / img_area
+    is_fiducial = ((area_ratio < max_area_ratio) & (aspect > min_aspect)
+                   & (solidity > 0.65) & (area > 10))
+    return _components_to_mask(labels, valid & ~is_fiducial)
 
 
 def _remove_rectangular_border(mask, min_fill=0.55, max_thickness=30):
@@ -134,59 +230,29 @@ def create_he_mask(img):
     # ✅ V8.1: connected component 전에 사각 테두리 제거
     raw = _remove_rectangular_border(raw)
 
-    n_labels, labels, stats, _ = cv2.connectedComponentsWithStats(raw, connectivity=8)
-    clean_raw = np.zeros_like(raw)
-    for i in range(1, n_labels):
-        area      = stats[i, cv2.CC_STAT_AREA]
-        bx        = stats[i, cv2.CC_STAT_LEFT]
-        by        = stats[i, cv2.CC_STAT_TOP]
-        bw        = stats[i, cv2.CC_STAT_WIDTH]
-        bh        = stats[i, cv2.CC_STAT_HEIGHT]
-        bbox_area = bw * bh
-        if bbox_area == 0:
-            continue
-        solid_ratio    = area / bbox_area
-        touches_border = bx <= 3 or by <= 3 or bx+bw >= w_img-3 or by+bh >= h_img-3
-        large_bbox     = bw > w_img * 0.5 and bh > h_img * 0.5
-        if touches_border and large_bbox and solid_ratio < 0.25:
-            continue
-        clean_raw[labels == i] = 255
-
+    clean_raw = _drop_border_frames(raw)
     clean_raw = _remove_fiducial_blobs(clean_raw, h_img, w_img)
-    k         = np.ones((5, 5), np.uint8)
-    mask      = cv2.morphologyEx(clean_raw, cv2.MORPH_OPEN,  k)
-    mask      = cv2.morphologyEx(mask,      cv2.MORPH_CLOSE, np.ones((9, 9), np.uint8))
+    # clean_raw is a fresh per-call array -> morphology can run in place on it
+    mask      = cv2.morphologyEx(clean_raw, cv2.MORPH_OPEN,  _K5, dst=clean_raw)
+    mask      = cv2.morphologyEx(mask,      cv2.MORPH_CLOSE, _K9, dst=mask)
     return mask
 
 
 def create_cosmx_mask(img, dilate_iterations=3):
-    gray       = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    saturation = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)[:, :, 1]
-    raw_mask   = (((gray < 250) & (gray > 5)) | (saturation > 20)).astype(np.uint8) * 255
+    # BGR→HSV 한 번만: V(=max(B,G,R))를 gray 대신 흰/검 배경 판정에 사용
+    _, saturation, value = cv2.split(cv2.cvtColor(img, cv2.COLOR_BGR2HSV))
+    # ((V < 250) & (V > 5)) | (saturation > 20), as single-pass uint8 OpenCV ops
+    _, nonwhite = cv2.threshold(value,      249, 255, cv2.THRESH_BINARY_INV)
+    _, nonblack = cv2.threshold(value,      5,   255, cv2.THRESH_BINARY)
+    _, sat_mask = cv2.threshold(saturation, 20,  255, cv2.THRESH_BINARY)
+    raw_mask    = cv2.bitwise_and(nonwhite, nonblack)
+    raw_mask    = cv2.bitwise_or(raw_mask, sat_mask, dst=raw_mask)
     h_img, w_img = raw_mask.shape
 
-    n_labels, labels, stats, _ = cv2.connectedComponentsWithStats(raw_mask, connectivity=8)
-    clean_raw = np.zeros_like(raw_mask)
-    for i in range(1, n_labels):
-        area      = stats[i, cv2.CC_STAT_AREA]
-        bx        = stats[i, cv2.CC_STAT_LEFT]
-        by        = stats[i, cv2.CC_STAT_TOP]
-        bw        = stats[i, cv2.CC_STAT_WIDTH]
-        bh        = stats[i, cv2.CC_STAT_HEIGHT]
-        bbox_area = bw * bh
-        if bbox_area == 0:
-            continue
-        solid_ratio    = area / bbox_area
-        touches_border = bx <= 3 or by <= 3 or bx+bw >= w_img-3 or by+bh >= h_img-3
-        large_bbox     = bw > w_img * 0.5 and bh > h_img * 0.5
-        if touches_border and large_bbox and solid_ratio < 0.25:
-            continue
-        clean_raw[labels == i] = 255
-
+    clean_raw = _drop_border_frames(raw_mask)
     clean_raw = _remove_fiducial_blobs(clean_raw, h_img, w_img)
-    kernel    = np.ones((7, 7), np.uint8)
-    mask      = cv2.dilate(clean_raw, kernel, iterations=dilate_iterations)
-    mask      = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, np.ones((15, 15), np.uint8))
+    mask      = cv2.dilate(clean_raw, _K7, dst=clean_raw, iterations=dilate_iterations)
+    mask      = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, _K15, dst=mask)
     return mask
 
 
@@ -240,36 +306,96 @@ def apply_transform(img, rotation, flip_x, flip_y):
     return np.ascontiguousarray(result)
 
 
+def canonical_orientation(rotation, flip_x, flip_y):
+    """
+    16 (rotation, flipX, flipY) 조합 → 8개 D4 원소로 축약
+    flipX+flipY == rot180, flipY == rot180+flipX
+    """
+    if flip_y:
+        return (rotation + 180) % 360, not flip_x
+    return rotation, flip_x
+
+
+def build_orientation_cache(img):
+    """8개 D4 방향 변환 결과를 한 번만 계산 (key: canonical_orientation)"""
+    return {(rotation, flip_x): apply_transform(img, rotation, flip_x, False)
+            for rotation in [0, 90, 180, 270] for flip_x in [False, True]}
+
+
 def translate_image(img, dx, dy):
-    M = np.float32([[1, 0, dx], [0, 1, dy]])
-    return cv2.warpAffine(img, M, (img.shape[1], img.shape[0]))
+    """정수 shift + zero fill (warpAffine 보간 없이 겹치는 영역만 복사)"""
+    out  = np.zeros_like(img)
+    h, w = img.shape[:2]
+    sx1 = max(0, -dx); sy1 = max(0, -dy)
+    dx1 = max(0,  dx); dy1 = max(0,  dy)
+    cw  = min(w - sx1, w - dx1)
+    ch  = min(h - sy1, h - dy1)
+    if cw > 0 and ch > 0:
+        out[dy1:dy1 + ch, dx1:dx1 + cw] = img[sy1:sy1 + ch, sx1:sx1 + cw]
+    return out
 
 
 # ============================================================================
 # FULL MATCHING (Phase Correlation)
 # ============================================================================
 
-def phase_correlation_match(he_mask, cosmx_mask_transformed):
-    he_h, he_w    = he_mask.shape
+def _padded_rfft2(a, fft_shape):
+    """next_fast_len 크기로 zero-pad 후 multi-thread rfft2 (pocketfft, 모든 core)"""
+    return scipy.fft.rfft2(a, s=fft_shape, workers=-1)
+
+
+def precompute_reference(he_mask):
+    """H&E 정규화 + FFT는 방향과 무관 → 한 번만 계산해서 16방향 전부 재사용"""
+    f1 = (np.float32(he_mask) - he_mask.mean()) / (he_mask.std() + 1e-6)
+    fft_shape = tuple(scipy.fft.next_fast_len(n, real=True) for n in he_mask.shape)
+    return np.conj(_padded_rfft2(f1, fft_shape)), he_mask.shape, fft_shape
+
+
+def _peak_centroid(corr, radius=2):
+    """
+    순환 상관 peak → (x, y) shift
+    cv2.phaseCorrelate와 동일하게 peak 주변 5x5 weighted centroid 사용 (wrap-around)
+    """
+    h, w   = corr.shape
+    py, px = np.unravel_index(corr.argmax(), corr.shape)
+    offs   = np.arange(-radius, radius + 1)
+    win    = corr[np.ix_((py + offs) % h, (px + offs) % w)]
+    total  = win.sum()
+    cy = py + (win.sum(axis=1) @ offs) / total
+    cx = px + (win.sum(axis=0) @ offs) / total
+    # [0, N) → [-N/2, N/2)
+    if cx >= w / 2: cx -= w
+    if cy >= h / 2: cy -= h
+    return cx, cy
+
+
+def phase_correlation_match(he_mask, cosmx_mask_transformed, reference=None):
+    if reference is None:
+        reference = precompute_reference(he_mask)
+    F1_conj, (he_h, he_w), fft_shape = reference
     cosmx_resized = cv2.resize(cosmx_mask_transformed, (he_w, he_h),
                                interpolation=cv2.INTER_AREA)
-    f1 = (np.float32(he_mask)    - he_mask.mean())    / (he_mask.std()    + 1e-6)
     f2 = (np.float32(cosmx_resized) - cosmx_resized.mean()) / (cosmx_resized.std() + 1e-6)
 
-    shift, _ = cv2.phaseCorrelate(f1, f2)
-    dx, dy   = int(round(shift[0])), int(round(shift[1]))
+    # cross-power spectrum → peak = shift (cv2.phaseCorrelate(f1, f2)와 같은 부호)
+    R     = F1_conj * _padded_rfft2(f2, fft_shape)
+    R    /= np.abs(R) + 1e-8
+    corr  = scipy.fft.irfft2(R, s=fft_shape, workers=-1)
+    # 정수 shift는 IoU 계산용, sub-pixel shift(sx, sy)는 norm_dx/norm_dy로 보존
+    sx, sy = _peak_centroid(corr)
+    dx, dy = int(round(sx)), int(round(sy))
     aligned  = translate_image(cosmx_resized, dx, dy)
 
-    inter = np.logical_and(he_mask > 0, aligned > 0).sum()
-    union = np.logical_or(he_mask  > 0, aligned > 0).sum()
+    # IoU도 compute_overlap_score와 같은 단일 패스 kernel 사용 (bool 임시 배열 4개 생략)
+    inter, union, _ = _overlap_counts(he_mask, aligned)
     iou   = inter / (union + 1e-6)
 
     if dx < -he_w // 4 or dy < -he_h // 4:
-        inter_c = np.logical_and(he_mask > 0, cosmx_resized > 0).sum()
-        union_c = np.logical_or(he_mask  > 0, cosmx_resized > 0).sum()
+        inter_c, union_c, _ = _overlap_counts(he_mask, cosmx_resized)
         iou_c   = inter_c / (union_c + 1e-6)
         if iou_c > iou:
             dx, dy = 0, 0
+            sx, sy = 0.0, 0.0
             iou    = iou_c
 
     # ✅ V8.1: (0,0) fallback 플래그
@@ -277,7 +403,7 @@ def phase_correlation_match(he_mask, cosmx_mask_transformed):
 
     return {
         'dx': dx, 'dy': dy,
-        'norm_dx': dx / he_w, 'norm_dy': dy / he_h,
+        'norm_dx': sx / he_w, 'norm_dy': sy / he_h,
         'score': iou, 'scale': 1.0,
         'method': 'phase_zero_fallback' if is_zero_fallback else 'phase_correlation'
     }
@@ -287,7 +413,65 @@ def phase_correlation_match(he_mask, cosmx_mask_transformed):
 # PARTIAL MATCHING — V8 스케일 수정
 # ============================================================================
 
-def template_matching_multiscale(he_mask, cosmx_mask_transformed, scales=None):
+def _cuda_available():
+    """OpenCV CUDA build + GPU 있으면 True (AUTO_ORIENT_CUDA=0 으로 끌 수 있음)"""
+    if os.environ.get('AUTO_ORIENT_CUDA', '1') == '0':
+        return False
+    try:
+        return cv2.cuda.getCudaEnabledDeviceCount() > 0
+    except (AttributeError, cv2.error):
+        return False
+
+
+USE_CUDA      = _cuda_available()
+# id(host array) -> (host array, GpuMat). coarse(he_small) / fine(he_mask) 호출이 번갈아
+# 오므로 슬롯 하나로는 매번 다시 upload됨 → 배열별로 한 번만 upload
+# (host array를 같이 들고 있어 id가 재사용되지 않음, 슬라이드가 바뀌면 비움)
+_GPU_IMAGES    = {}
+_GPU_IMAGE_MAX = 4
+_GPU_MATCHERS  = {}
+
+
+def _gpu_image(image):
+    """image의 GpuMat (처음 보는 배열일 때만 upload)"""
+    entry = _GPU_IMAGES.get(id(image))
+    if entry is None or entry[0] is not image:
+        if len(_GPU_IMAGES) >= _GPU_IMAGE_MAX:
+            _GPU_IMAGES.clear()
+        gpu_image = cv2.cuda_GpuMat()
+        gpu_image.upload(image)
+        entry = _GPU_IMAGES[id(image)] = (image, gpu_image)
+    return entry[1]
+
+
+def _match_template(image, templ, method):
+    """cv2.matchTemplate 대체 — CUDA 사용 가능하면 GPU에서 계산, 실패 시 CPU"""
+    if USE_CUDA:
+        try:
+            gpu_image = _gpu_image(image)
+            gpu_templ = cv2.cuda_GpuMat()
+            gpu_templ.upload(templ)
+            matcher = _GPU_MATCHERS.get(method)
+            if matcher is None:
+                matcher = _GPU_MATCHERS[method] = cv2.cuda.createTemplateMatching(cv2.CV_8U, method)
+            return matcher.match(gpu_image, gpu_templ).download()
+        except cv2.error:
+            pass
+    return cv2.matchTemplate(image, templ, method)
+
+
+COARSE_FACTOR = 0.25   # coarse pass 해상도 (H&E / template 1/4)
+COARSE_STRIDE = 3      # coarse pass는 scale 후보 3개 중 1개만
+FINE_RADIUS   = 0.1    # full-res는 coarse best scale ±0.1 안에서만
+
+
+def downsample_reference(he_mask):
+    """coarse scale 탐색용 1/4 H&E mask (alignment당 한 번)"""
+    return cv2.resize(he_mask, None, fx=COARSE_FACTOR, fy=COARSE_FACTOR,
+                      interpolation=cv2.INTER_AREA)
+
+
+def template_matching_multiscale(he_mask, cosmx_mask_transformed, scales=None, he_small=None):
     SCALE_BONUS = 0.12
     SCALE_MIN   = 0.5
     SCALE_MAX   = 1.15
@@ -301,6 +485,32 @@ def template_matching_multiscale(he_mask, cosmx_mask_transformed, scales=None):
     best_eff         = -1
     best_result      = None
 
+    # ✅ coarse-to-fine: 1/4 해상도에서 대략적인 scale 선택 → full-res는 그 주변만
+    if len(scales) > 2 * COARSE_STRIDE:
+        if he_small is None:
+            he_small = downsample_reference(he_mask)
+        coarse_best, coarse_scale = -1, None
+        for scale in scales[::COARSE_STRIDE]:
+            new_w = int(cosmx_w * scale)
+            new_h = int(cosmx_h * scale)
+            if new_w >= he_w or new_h >= he_h or new_w < 20 or new_h < 20:
+                continue
+            small_w = max(1, int(new_w * COARSE_FACTOR))
+            small_h = max(1, int(new_h * COARSE_FACTOR))
+            small_template = cv2.resize(cosmx_mask_transformed, (small_w, small_h),
+                                        interpolation=cv2.INTER_AREA)
+            try:
+                # coarse는 순위만 필요 → 평균 제거가 없는 TM_CCORR_NORMED (binary mask에서 순위 거의 동일)
+                result = _match_template(he_small, small_template, cv2.TM_CCORR_NORMED)
+            except cv2.error:
+                continue
+            scale_norm = max(0.0, min(1.0, (scale - SCALE_MIN) / (SCALE_MAX - SCALE_MIN)))
+            eff_score  = cv2.minMaxLoc(result)[1] + SCALE_BONUS * scale_norm
+            if eff_score > coarse_best:
+                coarse_best, coarse_scale = eff_score, scale
+        if coarse_scale is not None:
+            scales = [s for s in scales if abs(s - coarse_scale) <= FINE_RADIUS + 1e-9]
+
     for scale in scales:
         new_w = int(cosmx_w * scale)
         new_h = int(cosmx_h * scale)
@@ -312,8 +522,8 @@ def template_matching_multiscale(he_mask, cosmx_mask_transformed, scales=None):
         scaled_template = cv2.resize(cosmx_mask_transformed, (new_w, new_h),
                                      interpolation=cv2.INTER_AREA)
         try:
-            result             = cv2.matchTemplate(he_mask, scaled_template,
-                                                   cv2.TM_CCOEFF_NORMED)
+            result             = _match_template(he_mask, scaled_template,
+                                                 cv2.TM_CCOEFF_NORMED)
             _, max_val, _, max_loc = cv2.minMaxLoc(result)
 
             scale_norm = max(0.0, min(1.0, (scale - SCALE_MIN) / (SCALE_MAX - SCALE_MIN)))
@@ -336,6 +546,36 @@ def template_matching_multiscale(he_mask, cosmx_mask_transformed, scales=None):
     return best_result
 
 
+if _HAS_NUMBA:
+    @njit(parallel=True, fastmath=True)   # cache=True breaks reloading parallel kernels
+    def _overlap_counts(a, b):
+        """(inter, union, b_area) — compare/AND/OR/count를 한 번의 순회로 (임시 배열 없음)"""
+        inter = 0; union = 0; b_area = 0
+        for i in prange(a.shape[0]):
+            for j in range(a.shape[1]):
+                ai = 1 if a[i, j] > 0 else 0
+                bi = 1 if b[i, j] > 0 else 0
+                inter  += ai & bi
+                union  += ai | bi
+                b_area += bi
+        return inter, union, b_area
+
+    _warm = np.zeros((2, 2), np.uint8)
+    _overlap_counts(_warm[:1, :1], _warm[:1, :1])   # JIT warm-up (slice layout)
+    del _warm
+else:
+    def _overlap_counts(a, b):
+        """
+        (inter, union, b_area)
+        8 px/byte로 bit-pack → AND/OR/popcount 메모리 트래픽 1/8
+        (행 끝 padding bit는 0이라 count에 영향 없음)
+        """
+        pa = np.packbits(a > 0, axis=-1)
+        pb = np.packbits(b > 0, axis=-1)
+        return (int(np.bitwise_count(pa & pb).sum()), int(np.bitwise_count(pa | pb).sum()),
+                int(np.bitwise_count(pb).sum()))
+
+
 def compute_coverage_ratio(he_mask, cosmx_mask):
     """전체 tissue 면적 비율 (partial vs full 판단)"""
     return float((cosmx_mask > 0).sum()) / float((he_mask > 0).sum() + 1e-6)
@@ -369,9 +609,8 @@ def compute_overlap_score(he_mask, cosmx_mask_transformed, location, scale,
 
     he_r  = he_mask[dst_y1:dst_y2, dst_x1:dst_x2]
     cx_r  = scaled[src_y1:src_y1 + rh, src_x1:src_x1 + rw]
-    inter = float(np.logical_and(he_r > 0, cx_r > 0).sum())
-    union = float(np.logical_or(he_r  > 0, cx_r > 0).sum())
-    cx_area = float((cx_r > 0).sum())
+    inter, union, cx_area = _overlap_counts(he_r, cx_r)
+    inter = float(inter); union = float(union); cx_area = float(cx_area)
 
     iou       = inter / (union   + 1e-6)
     precision = inter / (cx_area + 1e-6)   # CosMx 중 HE 위에 올라간 비율
@@ -447,18 +686,46 @@ def ncc_tiebreaker(candidates, he_gray, cosmx_gray, top_n=4):
 # HYBRID MATCHING — V8.1
 # ============================================================================
 
-def _run_all_orientations(he_mask, cosmx_mask, match_fn, label="", coverage_ratio=1.0):
-    """16방향 전부 시도. phase_zero_fallback 감지 시 template matching 재시도."""
+# 이 점수를 넘는 방향이 나오면 16방향 탐색 조기 종료 (AUTO_ORIENT_EARLY_EXIT로 조정)
+EARLY_EXIT_THRESHOLD = float(os.environ.get('AUTO_ORIENT_EARLY_EXIT', 0.85))
+
+def _cached_match(match_cache, kind, orient_key, match_fn, he_mask, transformed):
+    """(kind, D4 방향)별 매칭 결과 재사용 — 같은 방향/같은 방법은 한 번만 계산"""
+    key = (kind, orient_key)
+    if key not in match_cache:
+        match_cache[key] = match_fn(he_mask, transformed)
+    return match_cache[key]
+
+
+def _run_all_orientations(he_mask, cosmx_mask, match_fn, label="", coverage_ratio=1.0,
+                          orient_cache=None, match_cache=None,
+                          template_fn=template_matching_multiscale, early_exit=None):
+    """
+    16방향 전부 시도. phase_zero_fallback 감지 시 template matching 재시도.
+    match_cache를 pass 간에 공유하면 dual-mode 재검토 시 이미 계산한
+    template matching 결과(phase fallback 포함)를 다시 계산하지 않음.
+    early_exit: combined_score가 이 값을 넘으면 나머지 방향은 건너뜀.
+    반환: (candidates, early_best) — early_best는 조기 종료를 일으킨 후보 (없으면 None),
+    candidates는 실제로 점수를 계산한 방향만 포함
+    """
+    if orient_cache is None:
+        orient_cache = build_orientation_cache(cosmx_mask)
+    if match_cache is None:
+        match_cache = {}
+    kind = 'template' if label == 'partial' else 'phase'
     candidates = []
     for rotation in [0, 90, 180, 270]:
         for flip_x in [False, True]:
             for flip_y in [False, True]:
-                transformed = apply_transform(cosmx_mask, rotation, flip_x, flip_y)
-                result      = match_fn(he_mask, transformed)
+                orient_key  = canonical_orientation(rotation, flip_x, flip_y)
+                transformed = orient_cache[orient_key]
+                result      = _cached_match(match_cache, kind, orient_key,
+                                            match_fn, he_mask, transformed)
 
                 # ✅ V8.1: phase (0,0) fallback → 즉시 template matching 대체
                 if result.get('method') == 'phase_zero_fallback':
-                    tmpl = template_matching_multiscale(he_mask, transformed)
+                    tmpl = _cached_match(match_cache, 'template', orient_key,
+                                         template_fn, he_mask, transformed)
                     if tmpl['score'] > result['score']:
                         result = tmpl
                         print(f"    [V8.2] Rot={rotation} FX={flip_x} FY={flip_y}: "
@@ -485,7 +752,13 @@ def _run_all_orientations(he_mask, cosmx_mask, match_fn, label="", coverage_rati
                     'match_score': result['score'], 'iou_score': overlap,
                     'combined_score': combined, 'method': result['method']
                 })
-    return candidates
+
+                # 정답 방향은 보통 하나이고 점수 차이가 큼 → 확실한 후보면 바로 종료
+                if early_exit is not None and combined > early_exit:
+                    print(f"    [Early exit] Rot={rotation} FX={flip_x} FY={flip_y}: "
+                          f"score {combined:.4f} > {early_exit}")
+                    return candidates, candidates[-1]
+    return candidates, None
 
 
 def find_best_alignment_hybrid(he_mask, cosmx_mask, mode='auto',
@@ -508,6 +781,17 @@ def find_best_alignment_hybrid(he_mask, cosmx_mask, mode='auto',
         score_mode = f"Blend (ratio={cov_ratio:.2f})"
     print(f"    Coverage ratio: {cov_ratio:.3f}  →  Scoring: {score_mode}")
 
+    # 16방향 = 8개 D4 변환 → 한 번만 계산해서 모든 pass에서 재사용
+    orient_cache = build_orientation_cache(cosmx_mask)
+    # H&E FFT도 한 번만 (phase correlation 전 pass 공용)
+    phase_match  = functools.partial(phase_correlation_match,
+                                     reference=precompute_reference(he_mask))
+    # 방향별 매칭 결과도 pass 간 공유 (dual-mode 재검토에서 재계산 방지)
+    match_cache  = {}
+    # template matching coarse pass용 1/4 H&E도 한 번만
+    template_match = functools.partial(template_matching_multiscale,
+                                       he_small=downsample_reference(he_mask))
+
     print("\n  [Testing] 16 orientations...")
     print("  " + "-" * 95)
     print("  {:>3} {:>6} {:>6} {:>6} {:>10} {:>10} {:>8} {:>12} {:>12}".format(
@@ -515,13 +799,17 @@ def find_best_alignment_hybrid(he_mask, cosmx_mask, mode='auto',
     print("  " + "-" * 95)
 
     if detected_mode == 'full':
-        candidates = _run_all_orientations(
-            he_mask, cosmx_mask, phase_correlation_match,
-            label='full', coverage_ratio=cov_ratio)
+        candidates, early_best = _run_all_orientations(
+            he_mask, cosmx_mask, phase_match,
+            label='full', coverage_ratio=cov_ratio,
+            orient_cache=orient_cache, match_cache=match_cache,
+            template_fn=template_match, early_exit=EARLY_EXIT_THRESHOLD)
     else:
-        candidates = _run_all_orientations(
-            he_mask, cosmx_mask, template_matching_multiscale,
-            label='partial', coverage_ratio=cov_ratio)
+        candidates, early_best = _run_all_orientations(
+            he_mask, cosmx_mask, template_match,
+            label='partial', coverage_ratio=cov_ratio,
+            orient_cache=orient_cache, match_cache=match_cache,
+            template_fn=template_match, early_exit=EARLY_EXIT_THRESHOLD)
 
     for i, c in enumerate(candidates, 1):
         print("  {:>3} {:>6} {:>6} {:>6} {:>10.4f} {:>10.4f} {:>8.2f} {:>12} {:>12}".format(
@@ -540,9 +828,11 @@ def find_best_alignment_hybrid(he_mask, cosmx_mask, mode='auto',
     if detected_mode == 'full' and best['combined_score'] < TRIGGER_THRESHOLD:
         print(f"\n  [V8.1 Dual-mode] Full={best['combined_score']:.4f} < {TRIGGER_THRESHOLD} "
               f"→ running Partial...")
-        partial_candidates = _run_all_orientations(
-            he_mask, cosmx_mask, template_matching_multiscale,
-            label='partial', coverage_ratio=cov_ratio)
+        partial_candidates, partial_early = _run_all_orientations(
+            he_mask, cosmx_mask, template_match,
+            label='partial', coverage_ratio=cov_ratio,
+            orient_cache=orient_cache, match_cache=match_cache,
+            template_fn=template_match, early_exit=EARLY_EXIT_THRESHOLD)
         partial_best = max(partial_candidates, key=lambda x: x['combined_score'])
 
         print(f"    Full best:    {best['combined_score']:.4f}")
@@ -552,6 +842,7 @@ def find_best_alignment_hybrid(he_mask, cosmx_mask, mode='auto',
             print("    → Switching to Partial result")
             candidates    = partial_candidates
             best          = partial_best
+            early_best    = partial_early
             detected_mode = 'partial_v8.1'
         else:
             print("    → Keeping Full result")
@@ -559,9 +850,11 @@ def find_best_alignment_hybrid(he_mask, cosmx_mask, mode='auto',
     elif detected_mode == 'partial' and best['combined_score'] < TRIGGER_THRESHOLD:
         print(f"\n  [V8.1 Dual-mode] Partial={best['combined_score']:.4f} < {TRIGGER_THRESHOLD} "
               f"→ running Full...")
-        full_candidates = _run_all_orientations(
-            he_mask, cosmx_mask, phase_correlation_match,
-            label='full', coverage_ratio=cov_ratio)
+        full_candidates, full_early = _run_all_orientations(
+            he_mask, cosmx_mask, phase_match,
+            label='full', coverage_ratio=cov_ratio,
+            orient_cache=orient_cache, match_cache=match_cache,
+            template_fn=template_match, early_exit=EARLY_EXIT_THRESHOLD)
         full_best = max(full_candidates, key=lambda x: x['combined_score'])
 
         print(f"    Partial best: {best['combined_score']:.4f}")
@@ -571,16 +864,21 @@ def find_best_alignment_hybrid(he_mask, cosmx_mask, mode='auto',
             print("    → Switching to Full result")
             candidates    = full_candidates
             best          = full_best
+            early_best    = full_early
             detected_mode = 'full_v8.1'
         else:
             print("    → Keeping Partial result")
 
-    # NCC tiebreaker
-    if he_gray is not None and cosmx_gray is not None:
+    # NCC tiebreaker — 조기 종료 시에는 건너뜀: 남은 방향은 점수가 없으므로
+    # 일부 후보만으로 재순위를 매기면 확실한 후보가 덜 맞는 방향으로 바뀔 수 있음
+    if early_best is not None:
+        best = early_best
+        print(f"\n  [NCC Tiebreaker] skipped (early exit, {len(candidates)}/16 scored)")
+    elif he_gray is not None and cosmx_gray is not None:
         best = ncc_tiebreaker(candidates, he_gray, cosmx_gray, top_n=4)
 
     sorted_c = sorted(candidates, key=lambda x: -x['combined_score'])
-    print("\n  [Top 3]")
+    print(f"\n  [Top 3] ({len(candidates)}/16 orientations scored)")
     for i, c in enumerate(sorted_c[:3], 1):
         print(f"    {i}. Rot={c['rotation']}° FX={c['flipX']} FY={c['flipY']} "
               f"Scale={c['scale']:.2f} Score={c['combined_score']:.4f}")
@@ -595,6 +893,46 @@ def find_best_alignment_hybrid(he_mask, cosmx_mask, mode='auto',
 # REFINEMENT
 # ============================================================================
 
+def _iou_grid(he_mask, cosmx_mask_transformed, scale, dxs, dys):
+    """
+    compute_iou_at_location(coverage_ratio=1.0)을 (dx, dy) 격자 전체에 대해 한 번에 계산
+    - inter: 검색 창 위 단일 cv2.matchTemplate(TM_CCORR) 상관
+    - HE / CosMx 면적: integral image 4-corner lookup
+    반환: shape (len(dxs), len(dys))
+    """
+    he_h, he_w       = he_mask.shape
+    cosmx_h, cosmx_w = cosmx_mask_transformed.shape
+    new_w = int(cosmx_w * scale); new_h = int(cosmx_h * scale)
+    if new_w < 1 or new_h < 1:
+        return np.zeros((len(dxs), len(dys)))
+
+    scaled = cv2.resize(cosmx_mask_transformed, (new_w, new_h), interpolation=cv2.INTER_AREA)
+    he_b   = (he_mask > 0).astype(np.uint8)
+    cx_b   = (scaled  > 0).astype(np.uint8)
+
+    # HE 밖은 0으로 채운 검색 창 → 모든 offset에서 template이 창 안에 들어감
+    x0, x1 = int(dxs[0]), int(dxs[-1])
+    y0, y1 = int(dys[0]), int(dys[-1])
+    window = np.zeros((y1 - y0 + new_h, x1 - x0 + new_w), np.float32)
+    sx2 = min(he_w, x1 + new_w); sy2 = min(he_h, y1 + new_h)
+    if sx2 > x0 and sy2 > y0:
+        window[:sy2 - y0, :sx2 - x0] = he_b[y0:sy2, x0:sx2]
+    corr  = cv2.matchTemplate(window, cx_b.astype(np.float32), cv2.TM_CCORR)
+    inter = np.rint(corr[np.ix_(dys - y0, dxs - x0)]).T
+
+    # 각 offset의 겹침 영역 (HE 경계로 clip)
+    X  = dxs[:, None]; Y = dys[None, :]
+    x1c = np.minimum(X, he_w);         y1c = np.minimum(Y, he_h)
+    x2c = np.minimum(X + new_w, he_w); y2c = np.minimum(Y + new_h, he_h)
+    ii_he = cv2.integral(he_b)
+    ii_cx = cv2.integral(cx_b)
+    he_area = (ii_he[y2c, x2c] - ii_he[y1c, x2c] - ii_he[y2c, x1c] + ii_he[y1c, x1c])
+    cx_area = ii_cx[y2c - y1c, x2c - x1c]
+
+    union = he_area + cx_area - inter
+    return inter / (union + 1e-6)
+
+
 def refine_alignment(he_mask, cosmx_mask, best, search_range=30, search_step=3):
     print("\n  [Refining] Local search...")
     transformed = apply_transform(cosmx_mask, best['rotation'], best['flipX'], best['flipY'])
@@ -603,13 +941,15 @@ def refine_alignment(he_mask, cosmx_mask, best, search_range=30, search_step=3):
     best_score  = best['combined_score']
     best_dx, best_dy = init_dx, init_dy
 
-    for dx in range(init_dx - search_range, init_dx + search_range + 1, search_step):
-        for dy in range(init_dy - search_range, init_dy + search_range + 1, search_step):
-            if dx < 0 or dy < 0:
-                continue
-            iou = compute_iou_at_location(he_mask, transformed, (dx, dy), scale)
-            if iou > best_score:
-                best_score = iou; best_dx, best_dy = dx, dy
+    dxs = np.arange(init_dx - search_range, init_dx + search_range + 1, search_step)
+    dys = np.arange(init_dy - search_range, init_dy + search_range + 1, search_step)
+    dxs = dxs[dxs >= 0]; dys = dys[dys >= 0]
+    if dxs.size and dys.size:
+        scores = _iou_grid(he_mask, transformed, scale, dxs, dys)
+        # argmax = 첫 번째 최댓값 (기존 dx→dy 순회 순서와 동일)
+        i, j   = np.unravel_index(np.argmax(scores), scores.shape)
+        if scores[i, j] > best_score:
+            best_score = float(scores[i, j]); best_dx, best_dy = int(dxs[i]), int(dys[j])
 
     print(f"    ({init_dx},{init_dy}) → ({best_dx},{best_dy})  "
           f"score {best['combined_score']:.4f} → {best_score:.4f}")
@@ -620,6 +960,21 @@ def refine_alignment(he_mask, cosmx_mask, best, search_range=30, search_step=3):
 # PROCESS
 # ============================================================================
 
+TRANSFORM_VERSION = "8.2"
+
+# transform.json 최상위 구조 (키 순서 고정) — None 자리는 process_single_slide에서 채움
+_TRANSFORM_TEMPLATE = {
+    "version": TRANSFORM_VERSION,
+    "slide_id": None,
+    "method": None,
+    "algorithm": f"hybrid v{TRANSFORM_VERSION} (precision/IoU auto-switch + border removal)",
+    "coverage_mode": None,
+    "original_sizes": None,
+    "transform": None,
+    "detection": None,
+}
+
+
 def process_single_slide(slide_id, data_dir, mode, refine, debug, size):
     slides_dir      = data_dir / 'slides'
     cosmx_dir       = data_dir / 'cosmx'
@@ -633,7 +988,7 @@ def process_single_slide(slide_id, data_dir, mode, refine, debug, size):
 
     cosmx_path = cosmx_dir / f"{slide_id}.png"
     if not cosmx_path.exists():
-        for f in cosmx_dir.glob("*.png"):
+        for f in iter_files(cosmx_dir, '.png'):
             if f.stem.lower() == slide_id.lower():
                 cosmx_path = f; break
         else:
@@ -654,9 +1009,11 @@ def process_single_slide(slide_id, data_dir, mode, refine, debug, size):
 
     if refine:
         dx, dy, score = refine_alignment(he_mask, cosmx_mask, best)
-        best['dx'] = dx; best['dy'] = dy
-        best['norm_dx'] = dx / he_mask.shape[1]
-        best['norm_dy'] = dy / he_mask.shape[0]
+        # 초기 위치가 그대로면 phase correlation의 sub-pixel 값 유지
+        if (dx, dy) != (best['dx'], best['dy']):
+            best['dx'] = dx; best['dy'] = dy
+            best['norm_dx'] = dx / he_mask.shape[1]
+            best['norm_dy'] = dy / he_mask.shape[0]
         best['refined_score'] = score
 
     he_orig_w, he_orig_h       = he_orig
@@ -664,46 +1021,46 @@ def process_single_slide(slide_id, data_dir, mode, refine, debug, size):
     size_ratio  = (cosmx_orig_w / he_orig_w + cosmx_orig_h / he_orig_h) / 2
     final_scale = best['scale']
 
-    transform_data = {
-        "version": "8.2",
-        "slide_id": slide_id,
-        "method": f"auto_orientation_v8.2_{detected_mode}",
-        "algorithm": "hybrid v8.2 (precision/IoU auto-switch + border removal)",
-        "coverage_mode": detected_mode,
-        "original_sizes": {
-            "he": [he_orig_w, he_orig_h],
-            "cosmx": [cosmx_orig_w, cosmx_orig_h],
-            "size_ratio": size_ratio
-        },
-        "transform": {
-            "rotation":          best['rotation'],
-            "flipX":             best['flipX'],
-            "flipY":             best['flipY'],
-            "translateX":        best['norm_dx'],
-            "translateY":        best['norm_dy'],
-            "translateX_pixels": best['dx'],
-            "translateY_pixels": best['dy'],
-            "scale":             final_scale
-        },
-        "detection": {
-            "combined_score": best['combined_score'],
-            "match_score":    best['match_score'],
-            "iou_score":      best['iou_score'],
-            "detection_scale": best['scale'],
-            "processing_size": size,
-            "top_candidates": [
-                {"rotation": c['rotation'], "flipX": c['flipX'], "flipY": c['flipY'],
-                 "scale": round(c['scale'], 3), "score": round(c['combined_score'], 4),
-                 "position": [c['dx'], c['dy']]}
-                for c in sorted(candidates, key=lambda x: -x['combined_score'])[:5]
-            ]
-        }
+    # 고정 필드/키 순서는 _TRANSFORM_TEMPLATE, 슬라이드별 값만 채움 (nested dict는 매번 새로 생성)
+    transform_data = dict(_TRANSFORM_TEMPLATE)
+    transform_data["slide_id"]      = slide_id
+    transform_data["method"]        = f"auto_orientation_v{TRANSFORM_VERSION}_{detected_mode}"
+    transform_data["coverage_mode"] = detected_mode
+    transform_data["original_sizes"] = {
+        "he": [he_orig_w, he_orig_h],
+        "cosmx": [cosmx_orig_w, cosmx_orig_h],
+        "size_ratio": size_ratio
+    }
+    transform_data["transform"] = {
+        "rotation":          best['rotation'],
+        "flipX":             best['flipX'],
+        "flipY":             best['flipY'],
+        "translateX":        best['norm_dx'],
+        "translateY":        best['norm_dy'],
+        "translateX_pixels": best['dx'],
+        "translateY_pixels": best['dy'],
+        "scale":             final_scale
+    }
+    transform_data["detection"] = {
+        "combined_score": best['combined_score'],
+        "match_score":    best['match_score'],
+        "iou_score":      best['iou_score'],
+        "detection_scale": best['scale'],
+        "processing_size": size,
+        "top_candidates": [
+            {"rotation": c['rotation'], "flipX": c['flipX'], "flipY": c['flipY'],
+             "scale": c['scale'], "score": c['combined_score'],
+             "position": [c['dx'], c['dy']]}
+            for c in heapq.nlargest(5, candidates, key=operator.itemgetter('combined_score'))
+        ]
     }
 
     cosmx_tiles_dir.mkdir(parents=True, exist_ok=True)
     out_json = cosmx_tiles_dir / "transform.json"
-    with open(out_json, 'w', encoding='utf-8') as f:
-        json.dump(transform_data, f, indent=2)
+    # orjson은 numpy scalar를 그대로 직렬화 → float()/round() 변환 불필요
+    with open(out_json, 'wb') as f:
+        f.write(orjson.dumps(transform_data,
+                             option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
     print(f"  [Saved] {out_json}")
 
     # 오버레이 저장
@@ -773,7 +1130,7 @@ def main():
         cosmx_dir = data_dir / 'cosmx'
         if not cosmx_dir.exists():
             print(f"[ERROR] {cosmx_dir}"); return False
-        files = list(cosmx_dir.glob("*.png"))
+        files = list(iter_files(cosmx_dir, '.png'))
         print(f"\n[Batch] {len(files)} files")
         results = []
         for i, f in enumerate(files, 1):
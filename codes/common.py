@@ -0,0 +1,63 @@
+"""
+codes/ 스크립트 공용 helper (make_dzi.py, make_cosmx_dzi.py, auto_orientation.py)
+
+pyvips / OpenSlide 없이 import 가능해야 함 — libvips dzsave는 backend/tile_generator.py
+"""
+
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+
+# 슬라이드 내부 타일 인코딩 스레드 수 (--all 모드에서는 set_tile_workers로 CPU 수 / workers)
+TILE_WORKERS = os.cpu_count() or 1
+
+# --skip-background: 1/64 축소 mask에서 조직이 하나도 없는 타일은 인코딩 생략
+BG_MASK_FACTOR = 64
+
+
+def iter_files(directory, ext):
+    """
+    directory 안의 `ext` 파일 Path를 스트리밍 (glob보다 가벼운 os.scandir, entry별 stat 없음)
+    확장자는 대소문자 무시 — Windows의 Path.glob('*.png')처럼 .PNG / .SVS도 포함
+    """
+    ext = ext.lower()
+    if not os.path.isdir(directory):
+        return  # glob처럼 없는 디렉토리는 빈 결과
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.name.lower().endswith(ext) and entry.is_file():
+                yield Path(entry.path)
+
+
+def tissue_mask(gray):
+    """1/BG_MASK_FACTOR 축소 grayscale → tissue mask — 흰 배경(>=240)과 검은 배경(<=5) 제외"""
+    gray = np.asarray(gray)
+    return (gray > 5) & (gray < 240)
+
+
+def is_background_tile(tissue, bounds, level_w, level_h):
+    """level 좌표의 타일 bbox를 mask 좌표로 투영해 조직 픽셀이 없으면 True"""
+    x1, y1, x2, y2 = bounds
+    mh, mw = tissue.shape
+    mx1 = int(x1 * mw / level_w); mx2 = max(mx1 + 1, math.ceil(x2 * mw / level_w))
+    my1 = int(y1 * mh / level_h); my2 = max(my1 + 1, math.ceil(y2 * mh / level_h))
+    return not tissue[my1:my2, mx1:mx2].any()
+
+
+def set_tile_workers(threads):
+    """map_tiles 스레드 수 설정 (ProcessPoolExecutor initializer에서 프로세스별로 호출)"""
+    global TILE_WORKERS
+    TILE_WORKERS = threads
+
+
+def map_tiles(fn, tasks):
+    """fn(task)를 TILE_WORKERS개 스레드로 실행 (결과는 tasks 순서). 1이면 스레드 없이 순차 실행"""
+    if TILE_WORKERS <= 1:
+        yield from map(fn, tasks)
+        return
+    with ThreadPoolExecutor(max_workers=TILE_WORKERS) as ex:
+        yield from ex.map(fn, tasks)
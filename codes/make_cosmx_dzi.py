@@ -12,8 +12,26 @@ Output: D:\병리\data\cosmx_tiles\{slide_id}\
 from pathlib import Path
 from PIL import Image
 import math
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import argparse
+import gc
+import io
 import shutil
+import sys
+import zipfile
+
+from common import (BG_MASK_FACTOR, is_background_tile, iter_files, map_tiles,
+                    set_tile_workers, tissue_mask)
+
+# pyvips dzsave 구현은 backend/tile_generator.py 하나를 공유
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+try:
+    from tile_generator import generate_dzi_tiles, dz_suffix, set_concurrency
+    _HAS_PYVIPS = True
+except (ImportError, OSError):
+    # pyvips 미설치 또는 libvips 바이너리 없음 → PIL 피라미드로 폴백
+    _HAS_PYVIPS = False
 
 Image.MAX_IMAGE_PIXELS = None
 
@@ -29,24 +47,71 @@ def get_level_dimensions(width, height, level, max_level):
     return max(1, math.ceil(width / scale)), max(1, math.ceil(height / scale))
 
 
-def get_tile_bounds(col, row, tile_size, overlap, level_w, level_h):
-    """Calculate tile bounds following DeepZoom standard"""
+def get_tile_bounds(col, row, tile_size, overlap, level_w, level_h, cols, rows):
+    """
+    Calculate tile bounds following DeepZoom standard
+    cols/rows는 레벨마다 상수 → 호출 측(level_info)에서 한 번만 계산해 전달
+    """
     grid_x = col * tile_size
     grid_y = row * tile_size
     
     x1 = grid_x - overlap if col > 0 else 0
     y1 = grid_y - overlap if row > 0 else 0
     
-    cols = math.ceil(level_w / tile_size)
-    rows = math.ceil(level_h / tile_size)
-    
     x2 = min(grid_x + tile_size + (overlap if col < cols - 1 else 0), level_w)
     y2 = min(grid_y + tile_size + (overlap if row < rows - 1 else 0), level_h)
     
-    return int(x1), int(y1), int(x2), int(y2)
+    return x1, y1, x2, y2
+
+
+def _tissue_mask(img):
+    """1/BG_MASK_FACTOR BOX 축소본의 tissue mask (기준은 common.tissue_mask)"""
+    small = img.resize((max(1, img.width // BG_MASK_FACTOR),
+                        max(1, img.height // BG_MASK_FACTOR)),
+                       Image.Resampling.BOX).convert('L')
+    return tissue_mask(small)
+
+
+def _encode_tile(args):
+    """
+    Crop + save one tile (ThreadPoolExecutor worker). 성공 시 True
+    level_prefix가 None이면 (--container zip) 파일 대신 인코딩된 bytes 반환
+    """
+    (scaled_img, col, row, bounds, level_prefix, fmt, quality, file_ext) = args
+    try:
+        x1, y1, x2, y2 = bounds
+        
+        if x2 <= x1 or y2 <= y1:
+            return False
+        
+        tile = scaled_img.crop((x1, y1, x2, y2))
+        if level_prefix is None:
+            tile_path = io.BytesIO()
+        else:
+            tile_path = f"{level_prefix}{col}_{row}.{file_ext}"
+        
+        if fmt == 'jpeg':
+            tile.save(tile_path, format='JPEG', quality=quality, subsampling=2)
+        else:
+            tile.save(tile_path, format='PNG', compress_level=6)
+        return tile_path.getvalue() if level_prefix is None else True
+    
+    except Exception as e:
+        return False
 
 
-def export_deepzoom(png_path, out_dir, tile_size=254, overlap=1, fmt="jpeg", quality=90):
+def _init_worker(threads):
+    """
+    프로세스당 스레드 수 설정 (ProcessPoolExecutor initializer)
+    workers개 프로세스가 각자 CPU 수만큼 스레드를 띄우면 cpu² 스레드 → threads = CPU 수 / workers
+    """
+    set_tile_workers(threads)
+    if _HAS_PYVIPS:
+        set_concurrency(threads)
+
+
+def export_deepzoom(png_path, out_dir, tile_size=254, overlap=1, fmt="jpeg", quality=90,
+                    skip_background=False, container='fs'):
     """
     Export PNG to DeepZoom tiles
     
@@ -57,6 +122,8 @@ def export_deepzoom(png_path, out_dir, tile_size=254, overlap=1, fmt="jpeg", qua
         overlap: Tile overlap (default: 1)
         fmt: Output format - 'jpeg' or 'png' (default: jpeg)
         quality: JPEG quality 1-100 (default: 90)
+        skip_background: Do not write tiles with no tissue (default: False)
+        container: 'fs' (.dzi + _files/) or 'zip' (single <slide_id>.zip, default: fs)
     """
     out_dir = Path(out_dir)
     png_path = Path(png_path)
@@ -72,12 +139,50 @@ def export_deepzoom(png_path, out_dir, tile_size=254, overlap=1, fmt="jpeg", qua
     print(f"  Input:  {png_path.name}")
     print(f"  Output: {slide_out}")
     
+    # --skip-background는 항상 PIL 경로: dzsave skip_blanks는 단색(흰) 배경과만 비교해서
+    # 검은 배경/빈 타일이 남음 → tissue mask 기준 하나로 두 백엔드 결과를 맞춤
+    if _HAS_PYVIPS and not skip_background:
+        try:
+            # dzsave는 기존 _files/ 위에 덮어쓰지 않음 → 먼저 삭제
+            files_dir = slide_out / f"{slide_id}_files"
+            if files_dir.exists():
+                shutil.rmtree(files_dir)
+            (slide_out / f"{slide_id}.zip").unlink(missing_ok=True)
+            (slide_out / f"{slide_id}.dzi").unlink(missing_ok=True)
+            # depth='onepixel' → 1x1 레벨까지 생성 (get_max_level과 동일한 레벨 수)
+            generate_dzi_tiles(png_path, out_dir,
+                               tile_size=tile_size,
+                               overlap=overlap,
+                               suffix=dz_suffix(fmt, quality),
+                               depth='onepixel',
+                               container=container)
+            return True
+        except Exception as e:
+            print(f"  [WARN] pyvips failed ({e}), falling back to PIL")
+            # 중간에 실패한 dzsave zip이 남아 있으면 서빙되지 않도록 삭제
+            (slide_out / f"{slide_id}.zip").unlink(missing_ok=True)
+    
+    zf = None
     try:
         # Open image
         img = Image.open(png_path)
         width, height = img.size
         print(f"  Size:   {width} x {height}")
         
+        # Convert RGBA to RGB for JPEG — 타일마다가 아니라 원본에서 한 번만
+        # (흰 배경 합성 후 축소 == 축소 후 합성, 하위 레벨은 모두 이 RGB 이미지에서 생성)
+        if fmt == 'jpeg' and img.mode != 'RGB':
+            if img.mode == 'RGBA':
+                rgb_img = Image.new('RGB', img.size, (255, 255, 255))
+                rgb_img.paste(img, mask=img.split()[3])
+            else:
+                rgb_img = img.convert('RGB')
+            img.close()
+            img = rgb_img
+        
+        tissue = _tissue_mask(img) if skip_background else None
+        tiles_skipped = 0
+        
         # Calculate pyramid levels
         max_level = get_max_level(width, height)
         level_count = max_level + 1
@@ -92,22 +197,36 @@ def export_deepzoom(png_path, out_dir, tile_size=254, overlap=1, fmt="jpeg", qua
   <Size Width="{width}" Height="{height}"/>
 </Image>'''
         
-        dzi_path = slide_out / f"{slide_id}.dzi"
-        dzi_path.write_text(dzi_content, encoding="utf-8")
-        
         # Create tiles directory (remove old if exists)
         files_dir = slide_out / f"{slide_id}_files"
         if files_dir.exists():
             shutil.rmtree(files_dir)
-        files_dir.mkdir(parents=True, exist_ok=True)
+        
+        if container == 'zip':
+            # 타일 수백만 개를 파일 하나로 — dzsave container='zip'과 같은 내부 구조
+            # (zipfile은 thread-safe 아님 → 스레드는 인코딩만, 쓰기는 여기서)
+            (slide_out / f"{slide_id}.dzi").unlink(missing_ok=True)
+            # 임시 이름에 쓰고 성공했을 때만 rename → 실패해도 central directory 없는
+            # 잘린 .zip이 <slide_id>.zip으로 남지 않음
+            zip_path = slide_out / f"{slide_id}.zip"
+            zip_tmp = zip_path.with_name(f"{zip_path.name}.part")
+            zf = zipfile.ZipFile(zip_tmp, 'w', zipfile.ZIP_STORED)
+            zf.writestr(f"{slide_id}.dzi", dzi_content)
+        else:
+            zf = None
+            (slide_out / f"{slide_id}.zip").unlink(missing_ok=True)
+            dzi_path = slide_out / f"{slide_id}.dzi"
+            dzi_path.write_text(dzi_content, encoding="utf-8")
+            files_dir.mkdir(parents=True, exist_ok=True)
         
         # Calculate total tiles
         total_tiles = 0
         level_info = []
         for level in range(level_count):
             level_w, level_h = get_level_dimensions(width, height, level, max_level)
-            cols = math.ceil(level_w / tile_size)
-            rows = math.ceil(level_h / tile_size)
+            # 정수 올림: math.ceil(level_w / tile_size)와 동일, float 변환 없음
+            cols = (level_w + tile_size - 1) // tile_size
+            rows = (level_h + tile_size - 1) // tile_size
             level_info.append((level, level_w, level_h, cols, rows))
             total_tiles += cols * rows
         
@@ -116,63 +235,84 @@ def export_deepzoom(png_path, out_dir, tile_size=254, overlap=1, fmt="jpeg", qua
         # Generate tiles
         tiles_generated = 0
         
-        for level, level_w, level_h, cols, rows in level_info:
-            level_dir = files_dir / str(level)
-            level_dir.mkdir(parents=True, exist_ok=True)
-            
-            # Scale image for this level
-            if level_w == width and level_h == height:
-                scaled_img = img
+        # 최대 레벨부터 내려가며 직전 레벨을 1/2로 축소 (mipmap)
+        # ceil(ceil(w/2^k)/2) == ceil(w/2^(k+1)) 이므로 레벨 크기는 get_level_dimensions와 동일
+        # 원본(img)도 다음 레벨을 만든 뒤 바로 해제 → 동시에 살아있는 건 인접 두 레벨뿐
+        scaled_img = img
+        img = None
+        for level, level_w, level_h, cols, rows in reversed(level_info):
+            if zf is None:
+                level_dir = files_dir / str(level)
+                level_dir.mkdir(exist_ok=True)  # files_dir는 이미 생성됨
+                # 타일마다 Path 객체를 만들지 않도록 문자열 prefix로 경로 조합
+                level_prefix = f"{level_dir}{os.sep}"
             else:
-                scaled_img = img.resize((level_w, level_h), Image.Resampling.LANCZOS)
+                level_prefix = None
+                zip_prefix = f"{slide_id}_files/{level}/"
             
-            for col in range(cols):
-                for row in range(rows):
-                    try:
-                        x1, y1, x2, y2 = get_tile_bounds(
-                            col, row, tile_size, overlap, level_w, level_h
-                        )
-                        
-                        if x2 <= x1 or y2 <= y1:
-                            continue
-                        
-                        tile = scaled_img.crop((x1, y1, x2, y2))
-                        tile_path = level_dir / f"{col}_{row}.{file_ext}"
-                        
-                        if fmt == 'jpeg':
-                            # Convert RGBA to RGB for JPEG
-                            if tile.mode == 'RGBA':
-                                bg = Image.new('RGB', tile.size, (255, 255, 255))
-                                bg.paste(tile, mask=tile.split()[3])
-                                tile = bg
-                            elif tile.mode != 'RGB':
-                                tile = tile.convert('RGB')
-                            tile.save(tile_path, format='JPEG', quality=quality, optimize=True)
-                        else:
-                            tile.save(tile_path, format='PNG', compress_level=6)
-                        
-                        tiles_generated += 1
-                        
-                        if tiles_generated % 500 == 0:
-                            progress = (tiles_generated / total_tiles) * 100
-                            print(f"  Progress: {progress:.1f}%", end='\r')
-                    
-                    except Exception as e:
-                        continue
+            # Scale previous level for this level
+            # Image.reduce(2): 2x2 평균 전용 경로 (크기는 올림 → get_level_dimensions와 동일)
+            if scaled_img.size != (level_w, level_h):
+                prev_img = scaled_img
+                if prev_img.mode in ('1', 'P'):
+                    scaled_img = prev_img.resize((level_w, level_h), Image.Resampling.BOX)
+                else:
+                    scaled_img = prev_img.reduce(2)
+                prev_img.close()
+                del prev_img
+                gc.collect()
             
-            # Free memory
-            if scaled_img is not img:
-                scaled_img.close()
+            # 타일 crop/encode를 스레드로 병렬 처리 (PIL JPEG/PNG 인코더는 GIL 해제)
+            scaled_img.load()  # lazy load는 스레드 간 경쟁 → 미리 decode
+            # row-major 순서: 소스 버퍼(행 우선) 접근 지역성 확보
+            # bounds는 타일당 한 번만 계산 (배경 필터와 인코딩이 공유)
+            tasks = [
+                (scaled_img, col, row,
+                 get_tile_bounds(col, row, tile_size, overlap, level_w, level_h, cols, rows),
+                 level_prefix, fmt, quality, file_ext)
+                for row in range(rows)
+                for col in range(cols)
+            ]
+            if tissue is not None:
+                n_tasks = len(tasks)
+                tasks = [t for t in tasks
+                         if not is_background_tile(tissue, t[3], level_w, level_h)]
+                tiles_skipped += n_tasks - len(tasks)
+            for task, ok in zip(tasks, map_tiles(_encode_tile, tasks)):
+                if not ok:
+                    continue
+                if zf is not None:
+                    zf.writestr(f"{zip_prefix}{task[1]}_{task[2]}.{file_ext}", ok)
+                
+                tiles_generated += 1
+                
+                if tiles_generated % 500 == 0:
+                    progress = (tiles_generated / total_tiles) * 100
+                    print(f"  Progress: {progress:.1f}%", end='\r')
+        
+        # Free memory
+        scaled_img.close()
+        del scaled_img, tasks
+        if zf is not None:
+            zf.close()
+            zf = None
+            os.replace(zip_tmp, zip_path)
         
         print(f"  ✓ Done: {tiles_generated:,} tiles          ")
+        if tiles_skipped:
+            print(f"  Skipped: {tiles_skipped:,} background tiles")
         
-        img.close()
         return True
         
     except Exception as e:
         print(f"  [ERROR] {e}")
         import traceback
         traceback.print_exc()
+        if zf is not None:
+            try:
+                zf.close()
+            finally:
+                zip_tmp.unlink(missing_ok=True)
         return False
 
 
@@ -185,6 +325,10 @@ def main():
     parser.add_argument('--format', type=str, default='jpeg', choices=['jpeg', 'png'], help='Tile format')
     parser.add_argument('--quality', type=int, default=90, help='JPEG quality (1-100)')
     parser.add_argument('--tile-size', type=int, default=254, help='Tile size')
+    parser.add_argument('--workers', type=int, default=None, help='Parallel slides in --all mode (default: CPU count; each holds one slide in memory)')
+    parser.add_argument('--threads', type=int, default=None, help='Tile encoding / libvips threads per slide (default: CPU count / workers)')
+    parser.add_argument('--skip-background', action='store_true', help='Do not write tiles without tissue in a 1/64 mask (viewer gets 404 for them); always uses the PIL tiler, not pyvips')
+    parser.add_argument('--container', type=str, default='fs', choices=['fs', 'zip'], help='fs: .dzi + _files/, zip: single <slide_id>.zip archive')
     
     args = parser.parse_args()
     
@@ -201,7 +345,7 @@ def main():
     
     if args.all:
         # Batch mode - process all PNG files
-        png_files = sorted(cosmx_dir.glob("*.png"))
+        png_files = sorted(iter_files(cosmx_dir, '.png'))
         
         if not png_files:
             print(f"[ERROR] No PNG files found in {cosmx_dir}")
@@ -210,19 +354,43 @@ def main():
         print(f"Found {len(png_files)} PNG files")
         print("=" * 60)
         
+        workers = args.workers or os.cpu_count() or 1
+        workers = min(workers, len(png_files))
+        # CPU를 workers개 프로세스가 나눠 씀 (프로세스 × 스레드 ≈ CPU 수)
+        threads = args.threads or max(1, (os.cpu_count() or 1) // workers)
+        print(f"Workers: {workers} x {threads} threads")
+        # 부모에서도 설정 → spawn된 자식은 VIPS_CONCURRENCY 환경변수를 물려받음
+        _init_worker(threads)
+        
         success = 0
         failed = 0
         
-        for i, png_file in enumerate(png_files, 1):
-            print(f"\n[{i}/{len(png_files)}] {png_file.stem}")
+        # 슬라이드마다 입력/출력이 독립적 → 프로세스 단위로 병렬 처리
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(threads,)) as ex:
+            futures = {
+                ex.submit(export_deepzoom, png_path, output_dir,
+                          tile_size=args.tile_size,
+                          fmt=args.format,
+                          quality=args.quality,
+                          skip_background=args.skip_background,
+                          container=args.container): png_path
+                for png_path in png_files
+            }
             
-            if export_deepzoom(png_file, output_dir,
-                             tile_size=args.tile_size,
-                             fmt=args.format,
-                             quality=args.quality):
-                success += 1
-            else:
-                failed += 1
+            for i, future in enumerate(as_completed(futures), 1):
+                png_path = futures[future]
+                try:
+                    ok = future.result()
+                except Exception as e:
+                    print(f"  [ERROR] {png_path.stem}: {e}")
+                    ok = False
+                
+                if ok:
+                    success += 1
+                else:
+                    failed += 1
+                print(f"\n[{i}/{len(png_files)}] {png_path.stem} {'✓' if ok else '✗'}")
         
         print()
         print("=" * 60)
@@ -240,10 +408,15 @@ def main():
         print(f"Processing: {args.slide_id}")
         print("=" * 60)
         
+        if args.threads:
+            _init_worker(args.threads)
+        
         if export_deepzoom(png_path, output_dir,
                          tile_size=args.tile_size,
                          fmt=args.format,
-                         quality=args.quality):
+                         quality=args.quality,
+                         skip_background=args.skip_background,
+                         container=args.container):
             print("\n✓ Success!")
         else:
             print("\n✗ Failed!")
@@ -12,11 +12,67 @@ Output: D:\병리\data\tiles\{slide_id}\
 from pathlib import Path
 from openslide import OpenSlide
 from openslide.deepzoom import DeepZoomGenerator
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import argparse
+import os
+import shutil
 import sys
 
+from common import (BG_MASK_FACTOR, is_background_tile, iter_files, map_tiles,
+                    set_tile_workers, tissue_mask)
 
-def export_deepzoom(svs_path, out_dir, tile_size=254, overlap=1, fmt="jpeg", quality=90):
+# pyvips dzsave 구현은 backend/tile_generator.py 하나를 공유
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+try:
+    from tile_generator import generate_dzi_tiles, dz_suffix, set_concurrency
+    _HAS_PYVIPS = True
+except (ImportError, OSError):
+    # pyvips 미설치 또는 libvips 바이너리 없음 → OpenSlide DeepZoomGenerator로 폴백
+    _HAS_PYVIPS = False
+
+def _tissue_mask(slide):
+    """1/BG_MASK_FACTOR 썸네일의 tissue mask (기준은 common.tissue_mask)"""
+    w, h = slide.dimensions
+    thumb = slide.get_thumbnail((max(1, w // BG_MASK_FACTOR),
+                                 max(1, h // BG_MASK_FACTOR))).convert('L')
+    return tissue_mask(thumb)
+
+
+def _grid_bounds(col, row, tile_size, level_w, level_h):
+    """overlap 없는 타일 격자 칸 (배경 판정용)"""
+    x1 = col * tile_size; y1 = row * tile_size
+    return x1, y1, min(x1 + tile_size, level_w), min(y1 + tile_size, level_h)
+
+
+def _save_tile(args):
+    """Read + save one DeepZoom tile (ThreadPoolExecutor worker). 성공 시 True"""
+    dz, level, col, row, level_prefix, fmt, quality, file_ext = args
+    try:
+        tile = dz.get_tile(level, (col, row))
+        tile_path = f"{level_prefix}{col}_{row}.{file_ext}"
+        
+        if fmt == 'jpeg':
+            tile.save(tile_path, format='JPEG', quality=quality, subsampling=2)
+        else:
+            tile.save(tile_path, format='PNG', compress_level=6)
+        return True
+    
+    except Exception as e:
+        return False
+
+
+def _init_worker(threads):
+    """
+    프로세스당 스레드 수 설정 (ProcessPoolExecutor initializer)
+    workers개 프로세스가 각자 CPU 수만큼 스레드를 띄우면 cpu² 스레드 → threads = CPU 수 / workers
+    """
+    set_tile_workers(threads)
+    if _HAS_PYVIPS:
+        set_concurrency(threads)
+
+
+def export_deepzoom(svs_path, out_dir, tile_size=254, overlap=1, fmt="jpeg", quality=90,
+                    skip_background=False):
     """
     Export SVS to DeepZoom tiles
     
@@ -27,6 +83,7 @@ def export_deepzoom(svs_path, out_dir, tile_size=254, overlap=1, fmt="jpeg", qua
         overlap: Tile overlap (default: 1)
         fmt: Output format - 'jpeg' or 'png' (default: jpeg)
         quality: JPEG quality 1-100 (default: 90)
+        skip_background: Do not write tiles with no tissue (default: False)
     """
     out_dir = Path(out_dir)
     out_dir.mkdir(parents=True, exist_ok=True)
@@ -43,6 +100,24 @@ def export_deepzoom(svs_path, out_dir, tile_size=254, overlap=1, fmt="jpeg", qua
     print(f"  Input:  {svs_path.name}")
     print(f"  Output: {slide_out}")
     
+    # --skip-background는 항상 OpenSlide 경로: dzsave skip_blanks는 단색(흰) 배경과만 비교해서
+    # 검은 배경/빈 타일이 남음 → tissue mask 기준 하나로 두 백엔드 결과를 맞춤
+    if _HAS_PYVIPS and not skip_background:
+        try:
+            # dzsave는 기존 _files/ 위에 덮어쓰지 않음 → 먼저 삭제
+            files_dir = slide_out / f"{slide_id}_files"
+            if files_dir.exists():
+                shutil.rmtree(files_dir)
+            # depth='onepixel' → DeepZoomGenerator와 같은 레벨 수 (1x1까지)
+            generate_dzi_tiles(svs_path, out_dir,
+                               tile_size=tile_size,
+                               overlap=overlap,
+                               suffix=dz_suffix(fmt, quality),
+                               depth='onepixel')
+            return True
+        except Exception as e:
+            print(f"  [WARN] pyvips failed ({e}), falling back to OpenSlide DeepZoom")
+    
     try:
         # Open slide
         slide = OpenSlide(str(svs_path))
@@ -73,35 +148,47 @@ def export_deepzoom(svs_path, out_dir, tile_size=254, overlap=1, fmt="jpeg", qua
         total_tiles = sum(cols * rows for cols, rows in dz.level_tiles)
         print(f"  Tiles:  {total_tiles:,}")
         
+        tissue = _tissue_mask(slide) if skip_background else None
+        tiles_skipped = 0
+        
         # Generate tiles
         tiles_generated = 0
         for level in range(dz.level_count):
             level_dir = files_dir / str(level)
-            level_dir.mkdir(parents=True, exist_ok=True)
+            level_dir.mkdir(exist_ok=True)  # files_dir는 이미 생성됨
+            # 타일마다 Path 객체를 만들지 않도록 문자열 prefix로 경로 조합
+            level_prefix = f"{level_dir}{os.sep}"
             
             cols, rows = dz.level_tiles[level]
+            level_w, level_h = dz.level_dimensions[level]
             
-            for col in range(cols):
-                for row in range(rows):
-                    try:
-                        tile = dz.get_tile(level, (col, row))
-                        tile_path = level_dir / f"{col}_{row}.{file_ext}"
-                        
-                        if fmt == 'jpeg':
-                            tile.save(tile_path, format='JPEG', quality=quality, optimize=True)
-                        else:
-                            tile.save(tile_path, format='PNG', compress_level=6)
-                        
-                        tiles_generated += 1
-                        
-                        if tiles_generated % 500 == 0:
-                            progress = (tiles_generated / total_tiles) * 100
-                            print(f"  Progress: {progress:.1f}%", end='\r')
-                    
-                    except Exception as e:
-                        continue
+            # OpenSlide read_region + PIL encode는 GIL 해제 → 스레드로 병렬 처리
+            # row-major 순서: 소스 버퍼(행 우선) 접근 지역성 확보
+            tasks = [
+                (dz, level, col, row, level_prefix, fmt, quality, file_ext)
+                for row in range(rows)
+                for col in range(cols)
+            ]
+            if tissue is not None:
+                n_tasks = len(tasks)
+                tasks = [t for t in tasks
+                         if not is_background_tile(
+                             tissue, _grid_bounds(t[2], t[3], tile_size, level_w, level_h),
+                             level_w, level_h)]
+                tiles_skipped += n_tasks - len(tasks)
+            for ok in map_tiles(_save_tile, tasks):
+                if not ok:
+                    continue
+                
+                tiles_generated += 1
+                
+                if tiles_generated % 500 == 0:
+                    progress = (tiles_generated / total_tiles) * 100
+                    print(f"  Progress: {progress:.1f}%", end='\r')
         
         print(f"  ✓ Done: {tiles_generated:,} tiles          ")
+        if tiles_skipped:
+            print(f"  Skipped: {tiles_skipped:,} background tiles")
         
         slide.close()
         return True
@@ -120,6 +207,9 @@ def main():
     parser.add_argument('--format', type=str, default='jpeg', choices=['jpeg', 'png'], help='Tile format')
     parser.add_argument('--quality', type=int, default=90, help='JPEG quality (1-100)')
     parser.add_argument('--tile-size', type=int, default=254, help='Tile size')
+    parser.add_argument('--workers', type=int, default=None, help='Parallel slides in --all mode (default: CPU count; each holds one slide in memory)')
+    parser.add_argument('--threads', type=int, default=None, help='Tile encoding / libvips threads per slide (default: CPU count / workers)')
+    parser.add_argument('--skip-background', action='store_true', help='Do not write tiles without tissue in a 1/64 mask (viewer gets 404 for them); always uses the OpenSlide tiler, not pyvips')
     
     args = parser.parse_args()
     
@@ -136,7 +226,7 @@ def main():
     
     if args.all:
         # Batch mode - process all SVS files
-        svs_files = sorted(slides_dir.glob("*.svs"))
+        svs_files = sorted(iter_files(slides_dir, '.svs'))
         
         if not svs_files:
             print(f"[ERROR] No SVS files found in {slides_dir}")
@@ -145,19 +235,42 @@ def main():
         print(f"Found {len(svs_files)} SVS files")
         print("=" * 60)
         
+        workers = args.workers or os.cpu_count() or 1
+        workers = min(workers, len(svs_files))
+        # CPU를 workers개 프로세스가 나눠 씀 (프로세스 × 스레드 ≈ CPU 수)
+        threads = args.threads or max(1, (os.cpu_count() or 1) // workers)
+        print(f"Workers: {workers} x {threads} threads")
+        # 부모에서도 설정 → spawn된 자식은 VIPS_CONCURRENCY 환경변수를 물려받음
+        _init_worker(threads)
+        
         success = 0
         failed = 0
         
-        for i, svs_file in enumerate(svs_files, 1):
-            print(f"\n[{i}/{len(svs_files)}] {svs_file.stem}")
+        # 슬라이드마다 입력/출력이 독립적 → 프로세스 단위로 병렬 처리
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(threads,)) as ex:
+            futures = {
+                ex.submit(export_deepzoom, svs_path, output_dir,
+                          tile_size=args.tile_size,
+                          fmt=args.format,
+                          quality=args.quality,
+                          skip_background=args.skip_background): svs_path
+                for svs_path in svs_files
+            }
             
-            if export_deepzoom(svs_file, output_dir, 
-                             tile_size=args.tile_size,
-                             fmt=args.format, 
-                             quality=args.quality):
-                success += 1
-            else:
-                failed += 1
+            for i, future in enumerate(as_completed(futures), 1):
+                svs_path = futures[future]
+                try:
+                    ok = future.result()
+                except Exception as e:
+                    print(f"  [ERROR] {svs_path.stem}: {e}")
+                    ok = False
+                
+                if ok:
+                    success += 1
+                else:
+                    failed += 1
+                print(f"\n[{i}/{len(svs_files)}] {svs_path.stem} {'✓' if ok else '✗'}")
         
         print()
         print("=" * 60)
@@ -175,10 +288,14 @@ def main():
         print(f"Processing: {args.slide_id}")
         print("=" * 60)
         
+        if args.threads:
+            _init_worker(args.threads)
+        
         if export_deepzoom(svs_path, output_dir,
                          tile_size=args.tile_size,
                          fmt=args.format,
-                         quality=args.quality):
+                         quality=args.quality,
+                         skip_background=args.skip_background):
             print("\n✓ Success!")
         else:
             print("\n✗ Failed!")
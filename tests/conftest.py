@@ -0,0 +1,6 @@
+import sys
+from pathlib import Path
+
+# codes/ 와 backend/ 는 패키지가 아니라 스크립트 디렉토리 → import 경로에 직접 추가
+ROOT = Path(__file__).resolve().parent.parent
+sys.path[:0] = [str(ROOT / 'codes'), str(ROOT / 'backend')]
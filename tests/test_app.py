@@ -0,0 +1,94 @@
+import os
+import stat
+
+import pytest
+
+
+@pytest.fixture
+def app_module(tmp_path, monkeypatch):
+    # app.py는 import 시 Windows 기본 데이터 폴더를 mkdir → 임시 폴더에서 import 후 경로 교체
+    monkeypatch.chdir(tmp_path)
+    import app
+    for name in ('TILES_DIR', 'ANNOTATIONS_DIR', 'COSMX_DIR', 'COSMX_TILES_DIR', 'QC_DIR'):
+        d = tmp_path / name.lower()
+        d.mkdir()
+        monkeypatch.setattr(app, name, d)
+    app._ANN_CACHE.clear()
+    return app
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def slide(app_module):
+    slide_dir = app_module.TILES_DIR / 'S1'
+    (slide_dir / 'S1_files' / '0').mkdir(parents=True)
+    (slide_dir / 'S1.dzi').write_text('<Image/>', encoding='utf-8')
+    (slide_dir / 'S1_files' / '0' / '0_0.jpeg').write_bytes(b'\xff\xd8' + b'\0' * 64)
+    return slide_dir
+
+
+def test_tiles_and_dzi_are_revalidated_not_immutable(client, app_module, slide):
+    for url, policy in [('/tiles/S1/S1.dzi', app_module.DZI_CACHE_CONTROL),
+                        ('/tiles/S1/S1_files/0/0_0.jpeg', app_module.TILE_CACHE_CONTROL)]:
+        resp = client.get(url)
+        assert resp.status_code == 200
+        assert resp.headers['Cache-Control'] == policy
+        assert 'immutable' not in policy
+        assert resp.headers.get('ETag') and resp.headers.get('Last-Modified')
+
+        again = client.get(url, headers={'If-None-Match': resp.headers['ETag']})
+        assert again.status_code == 304
+        assert again.headers['Cache-Control'] == policy
+
+
+def test_range_request_gets_tile_policy(client, app_module, slide):
+    resp = client.get('/tiles/S1/S1_files/0/0_0.jpeg', headers={'Range': 'bytes=0-3'})
+    assert resp.status_code == 206
+    assert resp.data == b'\xff\xd8\0\0'
+    assert resp.headers['Cache-Control'] == app_module.TILE_CACHE_CONTROL
+
+
+def test_missing_tile_and_api_are_not_cached(client, slide):
+    assert client.get('/tiles/S1/S1_files/0/9_9.jpeg').headers['Cache-Control'] == 'no-store'
+    assert client.get('/api/slides').headers['Cache-Control'] == 'no-store'
+
+
+def _feature_collection(name):
+    return {'type': 'FeatureCollection', 'features': [{'type': 'Feature', 'properties': {'name': name}}]}
+
+
+def test_annotation_rewrite_within_same_mtime_is_not_served_stale(client, app_module):
+    url = '/api/annotations/S1'
+    assert client.post(url, json=_feature_collection('aaaa')).status_code == 200
+    ann_file = app_module.ANNOTATIONS_DIR / 'S1.json'
+    old = ann_file.stat()
+    assert client.get(url).json['features'][0]['properties']['name'] == 'aaaa'
+
+    # 다른 worker의 저장이 같은 mtime tick, 같은 크기로 들어온 경우 (이 프로세스 캐시는 그대로)
+    cached = dict(app_module._ANN_CACHE)
+    assert client.post(url, json=_feature_collection('bbbb')).status_code == 200
+    os.utime(ann_file, ns=(old.st_atime_ns, old.st_mtime_ns))
+    app_module._ANN_CACHE.update(cached)
+    assert ann_file.stat().st_size == old.st_size
+
+    assert client.get(url).json['features'][0]['properties']['name'] == 'bbbb'
+    assert [p.name for p in app_module.ANNOTATIONS_DIR.iterdir()] == ['S1.json']
+    # temp file + os.replace여도 open(..., 'w')와 같은 권한 (mkstemp 기본값 0600 아님)
+    umask = os.umask(0)
+    os.umask(umask)
+    assert stat.S_IMODE(ann_file.stat().st_mode) == 0o666 & ~umask
+
+
+def test_annotation_save_requires_json_content_type(client, app_module):
+    body = b'{"type": "FeatureCollection", "features": []}'
+    resp = client.post('/api/annotations/S1', data=body, content_type='text/plain')
+    assert resp.status_code == 415
+    assert not (app_module.ANNOTATIONS_DIR / 'S1.json').exists()
+
+    resp = client.post('/api/annotations/S1', data=body, content_type='application/json')
+    assert resp.status_code == 200
+    assert (app_module.ANNOTATIONS_DIR / 'S1.json').read_bytes() == body
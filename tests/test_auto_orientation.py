@@ -0,0 +1,58 @@
+import cv2
+import numpy as np
+
+import auto_orientation as ao
+
+
+def _asymmetric_mask():
+    """D4 변환 8개가 모두 다른 모양이 되도록 L자 + 원 (회전/반전 대칭 없음)"""
+    m = np.zeros((240, 320), np.uint8)
+    cv2.rectangle(m, (40, 30), (200, 90), 255, -1)
+    cv2.rectangle(m, (40, 30), (90, 200), 255, -1)
+    cv2.circle(m, (250, 180), 35, 255, -1)
+    return m
+
+
+def _flip_x_case():
+    he_mask = _asymmetric_mask()
+    # 정답 rot180+flipY == (0, flipX) → 탐색 순서상 3번째 후보
+    return he_mask, np.ascontiguousarray(np.fliplr(he_mask))
+
+
+def _weakest_tiebreaker(calls):
+    """점수가 가장 낮은 후보를 고르는 tiebreaker — 호출되면 결과가 바뀜"""
+    def tiebreaker(candidates, he_gray, cosmx_gray, top_n=4):
+        calls.append(len(candidates))
+        return min(candidates, key=lambda c: c['combined_score'])
+    return tiebreaker
+
+
+def test_early_exit_winner_is_not_replaced_by_tiebreaker(monkeypatch):
+    he_mask, cosmx_mask = _flip_x_case()
+    calls = []
+    monkeypatch.setattr(ao, 'ncc_tiebreaker', _weakest_tiebreaker(calls))
+    monkeypatch.setattr(ao, 'EARLY_EXIT_THRESHOLD', 0.85)
+
+    best, candidates, _ = ao.find_best_alignment_hybrid(
+        he_mask, cosmx_mask, mode='full', he_gray=he_mask, cosmx_gray=cosmx_mask)
+
+    # 점수를 계산한 후보만 반환 (top_candidates / Top 3 출력용)
+    assert len(candidates) == 3
+    assert calls == []
+    assert (best['rotation'], best['flipX'], best['flipY']) == (0, True, False)
+    assert best['combined_score'] > 0.85
+    assert best is max(candidates, key=lambda c: c['combined_score'])
+
+
+def test_full_search_scores_all_orientations_and_runs_tiebreaker(monkeypatch):
+    he_mask, cosmx_mask = _flip_x_case()
+    calls = []
+    monkeypatch.setattr(ao, 'ncc_tiebreaker', _weakest_tiebreaker(calls))
+    monkeypatch.setattr(ao, 'EARLY_EXIT_THRESHOLD', float('inf'))
+
+    best, candidates, _ = ao.find_best_alignment_hybrid(
+        he_mask, cosmx_mask, mode='full', he_gray=he_mask, cosmx_gray=cosmx_mask)
+
+    assert len(candidates) == 16
+    assert calls == [16]
+    assert best is min(candidates, key=lambda c: c['combined_score'])
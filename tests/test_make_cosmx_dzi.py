@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+import make_cosmx_dzi
+
+
+def _write_mosaic(path):
+    """검은 배경 + 흰 띠 + 조직 한 덩어리 (CosMx export와 비슷한 배경 구성)"""
+    # 경계를 1/64 mask 칸(폭 70px)에 맞춤 → 섞인 칸이 조직으로 잡히지 않음
+    arr = np.zeros((500, 700, 3), np.uint8)
+    arr[:, 560:] = 255
+    arr[60:160, 80:300] = (180, 90, 200)
+    Image.fromarray(arr).save(path)
+    return path
+
+
+def _tiles(slide_out):
+    return sorted(p.relative_to(slide_out).as_posix() for p in slide_out.rglob('*.jpeg'))
+
+
+def _export(monkeypatch, png, out_dir, use_pyvips, skip_background):
+    monkeypatch.setattr(make_cosmx_dzi, '_HAS_PYVIPS', use_pyvips)
+    assert make_cosmx_dzi.export_deepzoom(png, out_dir, skip_background=skip_background)
+    return out_dir / png.stem
+
+
+def test_skip_background_never_goes_through_dzsave(tmp_path, monkeypatch):
+    png = _write_mosaic(tmp_path / 'S1.png')
+
+    dzsave_calls = []
+
+    def dzsave(*args, **kwargs):
+        dzsave_calls.append(kwargs)
+        raise RuntimeError('pyvips stub')   # export_deepzoom이 잡고 PIL로 폴백
+
+    monkeypatch.setattr(make_cosmx_dzi, 'generate_dzi_tiles', dzsave, raising=False)
+    monkeypatch.setattr(make_cosmx_dzi, 'dz_suffix', lambda *a: '.jpeg', raising=False)
+    with_vips = _export(monkeypatch, png, tmp_path / 'a', True, True)
+    pil_only = _export(monkeypatch, png, tmp_path / 'b', False, True)
+
+    assert dzsave_calls == []
+    tiles = _tiles(with_vips)
+    assert tiles == _tiles(pil_only)
+    # 검은 배경 (0,1)과 흰 띠만 있는 타일 (2,0)은 빠지고 조직 타일 (0,0)은 남음
+    assert 'S1_files/10/0_0.jpeg' in tiles
+    assert 'S1_files/10/0_1.jpeg' not in tiles
+    assert 'S1_files/10/2_0.jpeg' not in tiles
+
+
+@pytest.mark.parametrize('skip_background', [False, True])
+def test_pyvips_and_pil_write_the_same_tiles(tmp_path, monkeypatch, skip_background):
+    pytest.importorskip('pyvips')
+    if not make_cosmx_dzi._HAS_PYVIPS:
+        pytest.skip('libvips not usable')
+    png = _write_mosaic(tmp_path / 'S1.png')
+    vips_out = _export(monkeypatch, png, tmp_path / 'vips', True, skip_background)
+    pil_out = _export(monkeypatch, png, tmp_path / 'pil', False, skip_background)
+    assert _tiles(vips_out) == _tiles(pil_out)